@@ -14,6 +14,16 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 LOG_CHANNEL_ID = os.getenv("LOG_CHANNEL_ID")
 ADMIN_URL = os.getenv("ADMIN_URL")
 
+# Database pool configuration (tunable per deploy)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "50"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+# Set when DATABASE_URL points at pgbouncer in transaction pooling mode
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "").lower() in ("1", "true", "yes")
+
 # Timezone configuration
 TIMEZONE = "Asia/Tashkent"
 
@@ -2,10 +2,31 @@
 Database module for managing database connections and operations.
 Handles database pool creation and all database helper functions.
 """
+import asyncio
+import logging
+import secrets
+import string
+import time
 import asyncpg
+from dataclasses import dataclass
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from config import DATABASE_URL, TIMEZONE
+from config import (
+    DATABASE_URL, TIMEZONE,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_INACTIVE_LIFETIME,
+    DB_POOL_MAX_QUERIES, DB_COMMAND_TIMEOUT, DB_STATEMENT_CACHE_SIZE, DB_PGBOUNCER
+)
+from utils import TTLCache, generate_token
+
+logger = logging.getLogger(__name__)
+
+# Bot-wide timezone, built once instead of on every call
+_TZ = ZoneInfo(TIMEZONE)
+
+
+def _now_tashkent() -> datetime:
+    """Current Tashkent wall-clock time as a naive datetime (matches stored columns)."""
+    return datetime.now(_TZ).replace(tzinfo=None)
 
 # Valid plan types
 VALID_PLANS = {
@@ -15,6 +36,17 @@ VALID_PLANS = {
     '1_year': '1 year'
 }
 
+# Subscription length per plan (in days)
+PLAN_DAYS = {
+    '1_month': 30,
+    '3_months': 90,
+    '6_months': 180,
+    '1_year': 365
+}
+
+# Balance credited to the referrer for each referred user (in so'm)
+REFERRAL_BONUS = 10.00
+
 # Plan prices (in so'm)
 PLAN_PRICES = {
     '1_month': 5000.00,  # TODO: Set actual prices
@@ -46,58 +78,375 @@ PAYMENT_METHOD_NAMES = {
 }
 
 
+# Bump whenever _migrate_schema changes so existing databases pick up the new DDL
+CURRENT_SCHEMA_VERSION = 13
+
+# Queries run on (almost) every update; each pool connection prepares them once when it opens.
+# Helpers use these canonical strings via conn.hot rather than repeating the SQL inline.
+_HOT_QUERIES = {
+    'ban': """
+        SELECT muted_until FROM muted_users
+        WHERE user_id = $1 AND muted_until > LOCALTIMESTAMP
+    """,
+    'update_info': """
+        UPDATE users 
+        SET username = $2, name = $3 
+        WHERE user_id = $1
+          AND (username IS DISTINCT FROM $2 OR name IS DISTINCT FROM $3)
+    """,
+    'admin': "SELECT is_admin FROM users WHERE user_id = $1",
+    'token': "SELECT user_id FROM users WHERE token = $1",
+    'auth_state': """
+        SELECT
+            (SELECT muted_until FROM muted_users
+             WHERE user_id = $1 AND muted_until > LOCALTIMESTAMP) AS banned_until,
+            (SELECT user_id FROM users WHERE token = $2) AS target_id
+    """,
+    'partner': """
+        SELECT user2_id AS partner_id FROM chat_connections WHERE user1_id = $1
+        UNION ALL
+        SELECT user1_id FROM chat_connections WHERE user2_id = $1
+        LIMIT 1
+    """,
+    'get_or_create_user': """
+        WITH upsert AS (
+            INSERT INTO users (user_id, username, name, token)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO UPDATE
+            SET username = EXCLUDED.username, name = EXCLUDED.name
+            WHERE users.username IS DISTINCT FROM EXCLUDED.username
+               OR users.name IS DISTINCT FROM EXCLUDED.name
+            RETURNING token, (xmax = 0) AS is_new
+        )
+        SELECT token, is_new FROM upsert
+        UNION ALL
+        SELECT token, FALSE FROM users
+        WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM upsert)
+    """,
+}
+
+
+# Admin IDs rarely change; notify_admins_new_user reads them on every join
+ADMIN_IDS_TTL = 30
+_admin_ids_cache = {'ids': None, 'expires': 0}
+
+# Per-user admin flag and ban state, checked on (almost) every update.
+# Invalidated by invalidate_admin_cache and the set_user_ban / remove_user_ban helpers.
+USER_STATE_CACHE_TTL = 30
+_admin_flag_cache = TTLCache(maxsize=10_000, ttl=USER_STATE_CACHE_TTL)
+_ban_cache = TTLCache(maxsize=10_000, ttl=USER_STATE_CACHE_TTL)
+_MISSING = object()
+
+# Active chat partner per user (None = not in a chat), read on every chat message.
+# Postgres stays the source of truth; every helper that creates or ends a chat in this
+# process updates the entries, which is enough for the single-worker deploy.
+CHAT_PARTNER_CACHE_TTL = 300
+_partner_cache = TTLCache(maxsize=10_000, ttl=CHAT_PARTNER_CACHE_TTL)
+
+# Admin statistics panel; admins tend to click it repeatedly
+STATS_CACHE_TTL = 20
+_stats_cache = {'data': None, 'expires': 0}
+_stats_lock = asyncio.Lock()
+
+# Token -> user_id for /start deep links. A user's token never changes once issued,
+# so only hits are cached (a miss may become a real token moments later).
+TOKEN_CACHE_TTL = 300
+_token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+
+# Max concurrent Telegram sends when notifying admins
+NOTIFY_ADMINS_CONCURRENCY = 20
+
+
+class _BotConnection(asyncpg.Connection):
+    """asyncpg connection carrying the prepared statements for _HOT_QUERIES in `hot`."""
+
+    hot = None
+
+
+class _UnpreparedStatement:
+    """
+    Stand-in for a prepared statement behind pgbouncer (transaction mode).
+    Named statements don't survive there, so each call sends the query text again.
+    """
+
+    __slots__ = ('_conn', '_query')
+
+    def __init__(self, conn, query: str):
+        self._conn = conn
+        self._query = query
+
+    async def fetchval(self, *args):
+        return await self._conn.fetchval(self._query, *args)
+
+    async def fetchrow(self, *args):
+        return await self._conn.fetchrow(self._query, *args)
+
+    async def fetch(self, *args):
+        return await self._conn.fetch(self._query, *args)
+
+
+async def _init_connection(conn):
+    """Pool init callback: prepare the hot statements on a freshly opened connection."""
+    # Builtin types (BIGINT, TIMESTAMP, ...) have binary codecs out of the box; only the
+    # custom enums need a pg_type introspection. Pay it here, not on the first payment.
+    await conn.fetchrow("SELECT NULL::payment_status, NULL::payment_method")
+
+    if DB_PGBOUNCER:
+        conn.hot = {name: _UnpreparedStatement(conn, query) for name, query in _HOT_QUERIES.items()}
+        return
+    conn.hot = {name: await conn.prepare(query) for name, query in _HOT_QUERIES.items()}
+
+
+async def _reset_connection(conn):
+    """
+    Pool reset callback: intentionally a no-op.
+    asyncpg still rolls back any open transaction before calling this, but skips its default
+    RESET ALL / CLOSE ALL / UNLISTEN round trip. The bot keeps no session state (SET, LISTEN,
+    session advisory locks); persistent settings travel as server_settings instead.
+    """
+
+
+class BatchWriter:
+    """
+    Buffer rows in a bounded asyncio.Queue and write them with `flush(pool, rows)` in batches.
+    A batch is written once max_batch rows are queued or `interval` seconds after its first row.
+    Queued rows are lost if the process dies before they are flushed.
+    """
+
+    _STOP = object()
+
+    def __init__(self, pool, flush, max_batch: int = 500, interval: float = 0.1, maxsize: int = 10_000):
+        self._pool = pool
+        self._flush = flush
+        self._max_batch = max_batch
+        self._interval = interval
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._task = None
+
+    def start(self):
+        """Start the background flush task."""
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, row):
+        """Queue a row for the next batch; the row is dropped if the queue is full."""
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logger.warning("Batch writer queue is full, dropping row")
+
+    async def close(self):
+        """Write everything still queued and stop the flush task."""
+        if self._task is None:
+            return
+        await self._queue.put(self._STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._queue.get()
+            if row is self._STOP:
+                return
+            rows = [row]
+            deadline = loop.time() + self._interval
+            stop = False
+            while len(rows) < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is self._STOP:
+                    stop = True
+                    break
+                rows.append(row)
+            await self._write(rows)
+            if stop:
+                return
+
+    async def _write(self, rows):
+        try:
+            await self._flush(self._pool, rows)
+        except Exception:
+            logger.exception("Error writing batch of %d rows", len(rows))
+
+
+# Started by init_db; log_message / log_admin_action write directly when they aren't running
+_message_log_writer = None
+_admin_log_writer = None
+
+# Expired bans are ignored by is_user_banned and deleted in bulk by a background sweep
+BAN_SWEEP_INTERVAL = 300
+_BAN_SWEEP_LOCK_KEY = 0x616E6F6E  # arbitrary advisory lock key ("anon")
+_ban_sweep_task = None
+
+# The two batch writers and the ban sweep can each hold a pooled connection at once;
+# the pool needs room beyond that or handlers queue behind background work.
+BACKGROUND_POOL_CONNECTIONS = 3
+
+
+async def purge_expired_bans(pool) -> int:
+    """
+    Delete every expired ban. Returns the number of rows removed.
+    When several workers share the database only one sweeps at a time; the others skip.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # Transaction-scoped, so it is released on commit (and works behind pgbouncer)
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", _BAN_SWEEP_LOCK_KEY):
+                return 0
+            result = await conn.execute("DELETE FROM muted_users WHERE muted_until <= LOCALTIMESTAMP")
+    return int(result.split()[-1])
+
+
+async def _sweep_expired_bans(pool):
+    while True:
+        try:
+            await purge_expired_bans(pool)
+        except Exception:
+            logger.exception("Error purging expired bans")
+        await asyncio.sleep(BAN_SWEEP_INTERVAL)
+
+
+def _server_settings() -> dict:
+    """Startup parameters for pool connections."""
+    settings = {'application_name': 'anonim-bot', 'timezone': TIMEZONE}
+    if not DB_PGBOUNCER:
+        # pgbouncer rejects startup parameters it doesn't track (jit among them)
+        settings['jit'] = 'off'
+    return settings
+
+
 async def init_db():
     """
     Initialize database connection pool and create tables if they don't exist.
+    Migrations only run when the recorded schema version is behind CURRENT_SCHEMA_VERSION.
     Returns the connection pool.
     """
-    pool = await asyncpg.create_pool(DATABASE_URL)
-    async with pool.acquire() as conn:
-        # Create plan enum type if it doesn't exist (for subscriptions table)
-        await conn.execute("""
-            DO $$ BEGIN
-                CREATE TYPE plan_type AS ENUM ('1_month', '3_months', '6_months', '1_year');
-            EXCEPTION
-                WHEN duplicate_object THEN null;
-            END $$;
-        """)
+    # Migrate on a standalone connection first: pool connections prepare statements
+    # against these tables as soon as they are opened.
+    # pgbouncer in transaction mode can't keep named prepared statements,
+    # so asyncpg's statement cache is turned off there.
+    statement_cache_size = 0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE
 
-        # Create payment_status enum type if it doesn't exist
-        await conn.execute("""
-            DO $$ BEGIN
-                CREATE TYPE payment_status AS ENUM (
-                    'pending', 'processing', 'completed', 'failed', 
-                    'cancelled', 'refunded', 'expired', 'on_hold'
-                );
-            EXCEPTION
-                WHEN duplicate_object THEN null;
-            END $$;
-        """)
+    conn = await asyncpg.connect(DATABASE_URL, statement_cache_size=statement_cache_size)
+    try:
+        try:
+            schema_version = await conn.fetchval("SELECT MAX(version) FROM schema_meta")
+        except asyncpg.UndefinedTableError:
+            # Fresh database (or one created before schema versioning)
+            schema_version = None
+
+        if schema_version is None or schema_version < CURRENT_SCHEMA_VERSION:
+            await _migrate_schema(conn)
+    finally:
+        await conn.close()
+
+    if DB_POOL_MAX_SIZE <= BACKGROUND_POOL_CONNECTIONS:
+        logger.warning(
+            "DB_POOL_MAX_SIZE=%d leaves no connection for handlers while background writers "
+            "are busy; use at least %d", DB_POOL_MAX_SIZE, BACKGROUND_POOL_CONNECTIONS + 2
+        )
 
-        # Create payment_method enum type if it doesn't exist
-        # First try to add 'balance' to existing enum if it exists
-        await conn.execute("""
-            DO $$ 
-            BEGIN
-                -- Try to add 'balance' to existing enum if it exists
-                IF EXISTS (SELECT 1 FROM pg_type WHERE typname = 'payment_method') THEN
-                    -- Check if 'balance' already exists
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_enum 
-                        WHERE enumlabel = 'balance' 
-                        AND enumtypid = (SELECT oid FROM pg_type WHERE typname = 'payment_method')
-                    ) THEN
-                        ALTER TYPE payment_method ADD VALUE 'balance';
-                    END IF;
-                ELSE
-                    -- Create new enum with all values (including old ones for backward compatibility)
-                    CREATE TYPE payment_method AS ENUM ('click', 'payme', 'paynet', 'balance');
-                END IF;
-            EXCEPTION
-                WHEN duplicate_object THEN NULL;
-            END $$;
-        """)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        max_queries=DB_POOL_MAX_QUERIES,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=statement_cache_size,
+        connection_class=_BotConnection,
+        init=_init_connection,
+        reset=_reset_connection,
+        # Passed as startup parameters so they survive any session reset.
+        # Session timezone matches TIMEZONE so LOCALTIMESTAMP lines up with stored naive times.
+        server_settings=_server_settings()
+    )
+
+    global _message_log_writer
+    _message_log_writer = BatchWriter(pool, log_messages_bulk)
+    _message_log_writer.start()
+
+    global _admin_log_writer
+    _admin_log_writer = BatchWriter(pool, log_admin_actions, max_batch=50, maxsize=1000)
+    _admin_log_writer.start()
+
+    global _ban_sweep_task
+    _ban_sweep_task = asyncio.create_task(_sweep_expired_bans(pool))
+    return pool
 
+
+async def close_db(pool):
+    """Flush queued writes, stop background tasks and close the connection pool."""
+    global _message_log_writer, _admin_log_writer, _ban_sweep_task
+    if _ban_sweep_task is not None:
+        _ban_sweep_task.cancel()
+        try:
+            await _ban_sweep_task
+        except asyncio.CancelledError:
+            pass
+        _ban_sweep_task = None
+    if _message_log_writer is not None:
+        await _message_log_writer.close()
+        _message_log_writer = None
+    if _admin_log_writer is not None:
+        await _admin_log_writer.close()
+        _admin_log_writer = None
+    await pool.close()
+
+
+async def _migrate_schema(conn):
+    """
+    Create enum types and tables, apply column migrations and record CURRENT_SCHEMA_VERSION.
+    Every statement is idempotent, so re-running after a version bump is safe.
+    """
+    # Enum types in one simple-query message: plan_type (for subscriptions table),
+    # payment_status, and payment_method (adding 'balance' to an existing enum if missing).
+    # Kept outside the migration transaction: a value added by ALTER TYPE ... ADD VALUE
+    # cannot be used in the same transaction, and the migrations below use 'balance'.
+    await conn.execute("""
+        DO $$ BEGIN
+            CREATE TYPE plan_type AS ENUM ('1_month', '3_months', '6_months', '1_year');
+        EXCEPTION
+            WHEN duplicate_object THEN null;
+        END $$;
+
+        DO $$ BEGIN
+            CREATE TYPE payment_status AS ENUM (
+                'pending', 'processing', 'completed', 'failed', 
+                'cancelled', 'refunded', 'expired', 'on_hold'
+            );
+        EXCEPTION
+            WHEN duplicate_object THEN null;
+        END $$;
+
+        DO $$ 
+        BEGIN
+            -- Try to add 'balance' to existing enum if it exists
+            IF EXISTS (SELECT 1 FROM pg_type WHERE typname = 'payment_method') THEN
+                -- Check if 'balance' already exists
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_enum 
+                    WHERE enumlabel = 'balance' 
+                    AND enumtypid = (SELECT oid FROM pg_type WHERE typname = 'payment_method')
+                ) THEN
+                    ALTER TYPE payment_method ADD VALUE 'balance';
+                END IF;
+            ELSE
+                -- Create new enum with all values (including old ones for backward compatibility)
+                CREATE TYPE payment_method AS ENUM ('click', 'payme', 'paynet', 'balance');
+            END IF;
+        EXCEPTION
+            WHEN duplicate_object THEN NULL;
+        END $$;
+    """)
+
+    async with conn.transaction():
+        # All tables in one simple-query message instead of one round trip per table
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
@@ -112,67 +461,14 @@ async def init_db():
                 is_hidden BOOLEAN DEFAULT FALSE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
-        """)
-
-        # Add new columns to existing tables (migration for existing databases)
-        # PostgreSQL doesn't support IF NOT EXISTS in ALTER TABLE, so we check first
-        columns_to_add = [
-            ('is_premium', 'BOOLEAN DEFAULT FALSE'),
-            ('balance', 'NUMERIC(10, 2) DEFAULT 0.00'),
-            ('total_deposited', 'NUMERIC(10, 2) DEFAULT 0.00'),
-            ('referral_code', 'TEXT UNIQUE'),
-            ('referral_by', 'BIGINT REFERENCES users(user_id)'),
-            ('is_hidden', 'BOOLEAN DEFAULT FALSE'),
-        ]
-
-        for column_name, column_def in columns_to_add:
-            try:
-                # Check if column exists
-                column_exists = await conn.fetchval("""
-                    SELECT EXISTS (
-                        SELECT 1 
-                        FROM information_schema.columns 
-                        WHERE table_name = 'users' AND column_name = $1
-                    );
-                """, column_name)
-
-                if not column_exists:
-                    await conn.execute(f"""
-                        ALTER TABLE users 
-                        ADD COLUMN {column_name} {column_def};
-                    """)
-            except Exception as e:
-                # Log error but continue (column might already exist)
-                print(f"Warning: Could not add column {column_name}: {e}")
 
-        # Remove plan column from users table if it exists (migration)
-        try:
-            plan_column_exists = await conn.fetchval("""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'users' AND column_name = 'plan'
-                );
-            """)
-
-            if plan_column_exists:
-                await conn.execute("""
-                    ALTER TABLE users 
-                    DROP COLUMN IF EXISTS plan;
-                """)
-        except Exception as e:
-            print(f"Warning: Could not remove plan column: {e}")
-
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS muted_users(
                 user_id     BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
                 muted_until TIMESTAMP NOT NULL,
                 reason      TEXT,
                 created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
-        """)
 
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS message_log(
                 id          SERIAL PRIMARY KEY,
                 sender_id   BIGINT,
@@ -180,9 +476,7 @@ async def init_db():
                 message     TEXT,
                 sent_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
-        """)
 
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS chat_connections(
                 id          SERIAL PRIMARY KEY,
                 user1_id    BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
@@ -190,16 +484,12 @@ async def init_db():
                 created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(user1_id, user2_id)
             );
-        """)
 
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS chat_queue(
                 user_id     BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
                 joined_at   TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
-        """)
 
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS admin_logs(
                 id          SERIAL PRIMARY KEY,
                 admin_id    BIGINT NOT NULL,
@@ -207,9 +497,7 @@ async def init_db():
                 details     TEXT,
                 created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
-        """)
 
-        await conn.execute("""
             CREATE TABLE IF NOT EXISTS payments(
                 id              SERIAL PRIMARY KEY,
                 user_id         BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
@@ -220,208 +508,422 @@ async def init_db():
                 merchant_data   TEXT,
                 created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+
+            CREATE TABLE IF NOT EXISTS subscriptions(
+                id          SERIAL PRIMARY KEY,
+                user_id     BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+                plan        plan_type NOT NULL,
+                start_date  TIMESTAMP NOT NULL,
+                end_date    TIMESTAMP NOT NULL,
+                is_active   BOOLEAN DEFAULT TRUE,
+                created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS schema_meta(
+                version     INT PRIMARY KEY
+            );
         """)
 
-        # Add transaction_id column if it doesn't exist (migration)
-        try:
-            transaction_id_exists = await conn.fetchval("""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'payments' AND column_name = 'transaction_id'
-                );
+        # Add new columns to existing tables (migration for existing databases)
+        # PostgreSQL doesn't support IF NOT EXISTS in ALTER TABLE, so we check first.
+        # Each step runs in a savepoint so a failure doesn't abort the whole migration.
+        # Column metadata is fetched once per table and diffed here instead of probing per column.
+        existing_user_columns = {
+            row['column_name'] for row in await conn.fetch("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'users';
             """)
+        }
+        payment_column_types = {
+            row['column_name']: row['udt_name'] for row in await conn.fetch("""
+                SELECT column_name, udt_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'payments';
+            """)
+        }
 
-            if not transaction_id_exists:
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ADD COLUMN transaction_id TEXT;
-                """)
-                await conn.execute("""
-                    CREATE UNIQUE INDEX IF NOT EXISTS payments_transaction_id_unique 
-                    ON payments(transaction_id) WHERE transaction_id IS NOT NULL;
-                """)
-        except Exception as e:
-            print(f"Warning: Could not add transaction_id column: {e}")
+        columns_to_add = [
+            ('is_premium', 'BOOLEAN DEFAULT FALSE'),
+            ('balance', 'NUMERIC(10, 2) DEFAULT 0.00'),
+            ('total_deposited', 'NUMERIC(10, 2) DEFAULT 0.00'),
+            ('referral_code', 'TEXT UNIQUE'),
+            ('referral_by', 'BIGINT REFERENCES users(user_id)'),
+            ('is_hidden', 'BOOLEAN DEFAULT FALSE'),
+            # Denormalized referral stats, bumped by process_referral
+            ('referral_count', 'INT DEFAULT 0'),
+            ('referral_earnings', 'NUMERIC(12, 2) DEFAULT 0.00'),
+        ]
 
-        # Add merchant_data column if it doesn't exist (migration)
-        try:
-            merchant_data_exists = await conn.fetchval("""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'payments' AND column_name = 'merchant_data'
-                );
-            """)
+        missing_user_columns = [
+            (column_name, column_def) for column_name, column_def in columns_to_add
+            if column_name not in existing_user_columns
+        ]
+        if missing_user_columns:
+            try:
+                async with conn.transaction():
+                    add_clauses = ",\n".join(
+                        f"ADD COLUMN {column_name} {column_def}"
+                        for column_name, column_def in missing_user_columns
+                    )
+                    await conn.execute(f"ALTER TABLE users {add_clauses};")
+            except Exception as e:
+                # Log error but continue (column might already exist)
+                missing_names = ", ".join(column_name for column_name, _ in missing_user_columns)
+                logger.warning("Could not add columns %s: %s", missing_names, e)
 
-            if not merchant_data_exists:
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ADD COLUMN merchant_data TEXT;
-                """)
-        except Exception as e:
-            print(f"Warning: Could not add merchant_data column: {e}")
+        # Backfill the denormalized referral stats when their columns were just added
+        if 'referral_count' not in existing_user_columns:
+            try:
+                async with conn.transaction():
+                    await conn.execute("""
+                        UPDATE users u
+                        SET referral_count = c.referrals,
+                            referral_earnings = c.referrals * $1
+                        FROM (
+                            SELECT referral_by, COUNT(*) AS referrals
+                            FROM users
+                            WHERE referral_by IS NOT NULL
+                            GROUP BY referral_by
+                        ) c
+                        WHERE u.user_id = c.referral_by;
+                    """, REFERRAL_BONUS)
+            except Exception as e:
+                logger.warning("Could not backfill referral stats: %s", e)
+
+        # Remove plan column from users table if it exists (migration)
+        if 'plan' in existing_user_columns:
+            try:
+                async with conn.transaction():
+                    await conn.execute("""
+                        ALTER TABLE users 
+                        DROP COLUMN IF EXISTS plan;
+                    """)
+            except Exception as e:
+                logger.warning("Could not remove plan column: %s", e)
+
+        # Add transaction_id / merchant_data columns if they don't exist (migration)
+        payment_add_clauses = []
+        if 'transaction_id' not in payment_column_types:
+            payment_add_clauses.append("ADD COLUMN transaction_id TEXT")
+        if 'merchant_data' not in payment_column_types:
+            payment_add_clauses.append("ADD COLUMN merchant_data TEXT")
+
+        if payment_add_clauses:
+            try:
+                async with conn.transaction():
+                    await conn.execute(f"ALTER TABLE payments {', '.join(payment_add_clauses)};")
+                    if 'transaction_id' not in payment_column_types:
+                        await conn.execute("""
+                            CREATE UNIQUE INDEX IF NOT EXISTS payments_transaction_id_unique 
+                            ON payments(transaction_id) WHERE transaction_id IS NOT NULL;
+                        """)
+            except Exception as e:
+                logger.warning("Could not add payments columns: %s", e)
 
         # Migrate existing payments table status column from TEXT to payment_status enum
         try:
-            status_column_type = await conn.fetchval("""
-                SELECT udt_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'payments' AND column_name = 'status';
-            """)
+            async with conn.transaction():
+                if payment_column_types.get('status') == 'text':
+                    # Update any invalid values to 'pending'
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET status = 'pending' 
+                        WHERE status IS NOT NULL 
+                        AND status NOT IN ('pending', 'processing', 'completed', 'failed', 
+                                           'cancelled', 'refunded', 'expired', 'on_hold');
+                    """)
+
+                    # Create a temporary column with the new type
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        ADD COLUMN status_new payment_status;
+                    """)
+
+                    # Copy valid values
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET status_new = status::payment_status 
+                        WHERE status IS NOT NULL;
+                    """)
+
+                    # Set default for NULL values
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET status_new = 'pending' 
+                        WHERE status_new IS NULL;
+                    """)
+
+                    # Drop old column and rename new one
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        DROP COLUMN status;
+                    """)
+
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        RENAME COLUMN status_new TO status;
+                    """)
 
-            if status_column_type == 'text':
-                # Update any invalid values to 'pending'
-                await conn.execute("""
-                    UPDATE payments 
-                    SET status = 'pending' 
-                    WHERE status IS NOT NULL 
-                    AND status NOT IN ('pending', 'processing', 'completed', 'failed', 
-                                       'cancelled', 'refunded', 'expired', 'on_hold');
-                """)
-
-                # Create a temporary column with the new type
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ADD COLUMN status_new payment_status;
-                """)
-
-                # Copy valid values
-                await conn.execute("""
-                    UPDATE payments 
-                    SET status_new = status::payment_status 
-                    WHERE status IS NOT NULL;
-                """)
-
-                # Set default for NULL values
-                await conn.execute("""
-                    UPDATE payments 
-                    SET status_new = 'pending' 
-                    WHERE status_new IS NULL;
-                """)
-
-                # Drop old column and rename new one
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    DROP COLUMN status;
-                """)
-
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    RENAME COLUMN status_new TO status;
-                """)
-
-                # Set NOT NULL constraint and default
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ALTER COLUMN status SET NOT NULL,
-                    ALTER COLUMN status SET DEFAULT 'pending';
-                """)
+                    # Set NOT NULL constraint and default
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        ALTER COLUMN status SET NOT NULL,
+                        ALTER COLUMN status SET DEFAULT 'pending';
+                    """)
         except Exception as e:
             # Log error but continue (column might already be correct type)
-            print(f"Warning: Could not migrate payments status column: {e}")
+            logger.warning("Could not migrate payments status column: %s", e)
 
         # Migrate existing payments table method column from TEXT to payment_method enum
         try:
-            method_column_type = await conn.fetchval("""
-                SELECT udt_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'payments' AND column_name = 'method';
-            """)
+            async with conn.transaction():
+                if payment_column_types.get('method') == 'text':
+                    # Update any invalid values to 'balance' (default for new system)
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET method = 'balance' 
+                        WHERE method IS NOT NULL 
+                        AND method NOT IN ('click', 'payme', 'paynet', 'balance');
+                    """)
 
-            if method_column_type == 'text':
-                # Update any invalid values to 'balance' (default for new system)
-                await conn.execute("""
-                    UPDATE payments 
-                    SET method = 'balance' 
-                    WHERE method IS NOT NULL 
-                    AND method NOT IN ('click', 'payme', 'paynet', 'balance');
-                """)
-
-                # Create a temporary column with the new type
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ADD COLUMN method_new payment_method;
-                """)
-
-                # Copy valid values (including 'balance' if it exists)
-                await conn.execute("""
-                    UPDATE payments 
-                    SET method_new = method::payment_method 
-                    WHERE method IS NOT NULL 
-                    AND method IN ('click', 'payme', 'paynet', 'balance');
-                """)
-
-                # Set default for NULL or invalid values to 'balance'
-                await conn.execute("""
-                    UPDATE payments 
-                    SET method_new = 'balance' 
-                    WHERE method_new IS NULL;
-                """)
-
-                # Drop old column and rename new one
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    DROP COLUMN method;
-                """)
-
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    RENAME COLUMN method_new TO method;
-                """)
-
-                # Set NOT NULL constraint
-                await conn.execute("""
-                    ALTER TABLE payments 
-                    ALTER COLUMN method SET NOT NULL;
-                """)
+                    # Create a temporary column with the new type
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        ADD COLUMN method_new payment_method;
+                    """)
+
+                    # Copy valid values (including 'balance' if it exists)
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET method_new = method::payment_method 
+                        WHERE method IS NOT NULL 
+                        AND method IN ('click', 'payme', 'paynet', 'balance');
+                    """)
+
+                    # Set default for NULL or invalid values to 'balance'
+                    await conn.execute("""
+                        UPDATE payments 
+                        SET method_new = 'balance' 
+                        WHERE method_new IS NULL;
+                    """)
+
+                    # Drop old column and rename new one
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        DROP COLUMN method;
+                    """)
+
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        RENAME COLUMN method_new TO method;
+                    """)
+
+                    # Set NOT NULL constraint
+                    await conn.execute("""
+                        ALTER TABLE payments 
+                        ALTER COLUMN method SET NOT NULL;
+                    """)
         except Exception as e:
             # Log error but continue (column might already be correct type)
-            print(f"Warning: Could not migrate payments method column: {e}")
+            logger.warning("Could not migrate payments method column: %s", e)
 
+        # At most one active subscription per user (activate_subscription upserts on it).
+        # Older duplicates are deactivated first, keeping the one that ends last.
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions(
-                id          SERIAL PRIMARY KEY,
-                user_id     BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
-                plan        plan_type NOT NULL,
-                start_date  TIMESTAMP NOT NULL,
-                end_date    TIMESTAMP NOT NULL,
-                is_active   BOOLEAN DEFAULT TRUE,
-                created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            UPDATE subscriptions s
+            SET is_active = FALSE
+            WHERE is_active AND EXISTS (
+                SELECT 1 FROM subscriptions newer
+                WHERE newer.user_id = s.user_id AND newer.is_active
+                  AND (newer.end_date, newer.id) > (s.end_date, s.id)
             );
+            CREATE UNIQUE INDEX IF NOT EXISTS subs_one_active ON subscriptions(user_id) WHERE is_active;
         """)
-    return pool
+
+        # New payments may only use the 'balance' method. Checked on INSERT only, so
+        # status/transaction_id updates on legacy click/payme/paynet rows keep working
+        # (a CHECK constraint, even NOT VALID, is re-checked on every UPDATE).
+        # Raises check_violation, which create_payment reports as an invalid method.
+        await conn.execute("""
+            ALTER TABLE payments DROP CONSTRAINT IF EXISTS payments_method_balance;
+
+            CREATE OR REPLACE FUNCTION payments_method_balance() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.method IS DISTINCT FROM 'balance' THEN
+                    RAISE EXCEPTION 'new payments must use the balance method, got %', NEW.method
+                        USING ERRCODE = 'check_violation';
+                END IF;
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS payments_method_balance_trg ON payments;
+            CREATE TRIGGER payments_method_balance_trg BEFORE INSERT ON payments
+                FOR EACH ROW EXECUTE FUNCTION payments_method_balance();
+        """)
+
+        # Indexes for the hot read helpers
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_is_admin ON users(user_id) WHERE is_admin;
+            CREATE INDEX IF NOT EXISTS idx_subs_user_active ON subscriptions(user_id, end_date DESC) WHERE is_active;
+            CREATE INDEX IF NOT EXISTS idx_muted_user ON muted_users(user_id, muted_until);
+            CREATE INDEX IF NOT EXISTS chat_queue_joined_at_idx ON chat_queue(joined_at);
+            CREATE INDEX IF NOT EXISTS idx_muted_until ON muted_users(muted_until);
+            CREATE INDEX IF NOT EXISTS message_log_sender_sent_idx ON message_log(sender_id, sent_at DESC);
+            CREATE INDEX IF NOT EXISTS users_referral_by_idx ON users(referral_by) WHERE referral_by IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS message_log_pair_idx
+                ON message_log(LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), sent_at);
+            -- user1_id lookups are served by the UNIQUE (user1_id, user2_id) index
+            CREATE INDEX IF NOT EXISTS chat_connections_user2_idx ON chat_connections(user2_id) INCLUDE (user1_id);
+            CREATE INDEX IF NOT EXISTS users_created_at_idx ON users(created_at DESC, user_id DESC);
+        """)
+
+        # Exact user total kept by a trigger, so the admin panels never COUNT(*) users.
+        # CREATE TRIGGER blocks concurrent inserts until commit, so the seed can't drift.
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS bot_counters(
+                name    TEXT PRIMARY KEY,
+                value   BIGINT NOT NULL
+            );
+
+            CREATE OR REPLACE FUNCTION bot_counters_users() RETURNS trigger AS $$
+            BEGIN
+                UPDATE bot_counters
+                SET value = value + CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END
+                WHERE name = 'users';
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS users_count_trg ON users;
+            CREATE TRIGGER users_count_trg AFTER INSERT OR DELETE ON users
+                FOR EACH ROW EXECUTE FUNCTION bot_counters_users();
+
+            INSERT INTO bot_counters (name, value) SELECT 'users', COUNT(*) FROM users
+            ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;
+        """)
+
+        await conn.execute("""
+            INSERT INTO schema_meta (version) VALUES ($1)
+            ON CONFLICT (version) DO NOTHING
+        """, CURRENT_SCHEMA_VERSION)
 
 
 async def get_user_by_token(pool, token: str):
-    """Get user information by their unique token."""
-    async with pool.acquire() as conn:
-        return await conn.fetchrow("SELECT user_id FROM users WHERE token = $1", token)
+    """Get the user_id owning a token. Returns user_id or None."""
+    user_id = _token_cache.get(token)
+    if user_id is None:
+        async with pool.acquire() as conn:
+            user_id = await conn.hot['token'].fetchval(token)
+        if user_id is not None:
+            _token_cache.set(token, user_id)
+    return user_id
 
 
 async def is_user_banned(pool, user_id: int) -> tuple[bool, datetime | None]:
     """
     Check if a user is currently banned.
     Returns (is_banned: bool, banned_until: datetime | None).
-    Automatically removes expired ban records.
+    Expired ban records are ignored here and removed by the periodic ban sweep.
     """
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT muted_until FROM muted_users WHERE user_id = $1", user_id)
-        if row:
-            banned_until = row["muted_until"]
-            current_time = datetime.now(ZoneInfo(TIMEZONE)).replace(tzinfo=None)
-            if banned_until > current_time:
-                return True, banned_until
-            else:
-                await conn.execute("DELETE FROM muted_users WHERE user_id = $1", user_id)
-        return False, None
+    banned_until = _ban_cache.get(user_id, _MISSING)
+    if banned_until is _MISSING:
+        # A ban set or lifted while the query runs must not be overwritten by its result
+        generation = _ban_cache.generation(user_id)
+        # muted_until is stored as naive Tashkent time; pool sessions run in TIMEZONE,
+        # so the query compares it against LOCALTIMESTAMP
+        async with pool.acquire() as conn:
+            banned_until = await conn.hot['ban'].fetchval(user_id)
+        _ban_cache.set_if_unchanged(user_id, banned_until, generation)
+
+    # A cached ban may have run out since it was cached
+    if banned_until is not None and banned_until > _now_tashkent():
+        return True, banned_until
+    return False, None
+
+
+@dataclass(slots=True, frozen=True)
+class AuthState:
+    """Result of get_auth_state: the sender's active ban (if any) and the token's owner."""
+    banned_until: datetime | None
+    target_id: int | None
+
+
+async def get_auth_state(pool, user_id: int, token: str) -> AuthState:
+    """
+    Ban state of the sender and owner of the token, as needed by a /start deep link.
+    Both halves come from the ban/token caches when warm, otherwise from one query.
+    """
+    banned_until = _ban_cache.get(user_id, _MISSING)
+    target_id = _token_cache.get(token)
+    if banned_until is _MISSING or target_id is None:
+        # Same generation-checked fill as is_user_banned
+        ban_generation = _ban_cache.generation(user_id)
+        async with pool.acquire() as conn:
+            row = await conn.hot['auth_state'].fetchrow(user_id, token)
+        banned_until, target_id = row["banned_until"], row["target_id"]
+        _ban_cache.set_if_unchanged(user_id, banned_until, ban_generation)
+        if target_id is not None:
+            _token_cache.set(token, target_id)
+
+    if banned_until is not None and banned_until <= _now_tashkent():
+        banned_until = None
+    return AuthState(banned_until, target_id)
+
+
+async def set_user_ban(pool, user_id: int, muted_until: datetime, reason: str = None):
+    """Ban a user until muted_until (naive Tashkent time), replacing any existing ban."""
+    await pool.execute("""
+        INSERT INTO muted_users (user_id, muted_until, reason)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE
+        SET muted_until = $2, reason = $3, created_at = CURRENT_TIMESTAMP
+    """, user_id, muted_until, reason)
+    _ban_cache.pop(user_id)
+    invalidate_bot_statistics()
+
+
+async def set_user_bans(pool, user_ids: list[int], muted_until: datetime, reason: str = None) -> list[int]:
+    """
+    Ban many users until muted_until in one statement, replacing any existing bans.
+    IDs without a users row are skipped. Returns the IDs that were banned.
+    """
+    rows = await pool.fetch("""
+        INSERT INTO muted_users (user_id, muted_until, reason)
+        SELECT u.user_id, $2, $3
+        FROM users u
+        WHERE u.user_id = ANY($1::bigint[])
+        ON CONFLICT (user_id) DO UPDATE
+        SET muted_until = EXCLUDED.muted_until, reason = EXCLUDED.reason, created_at = CURRENT_TIMESTAMP
+        RETURNING user_id
+    """, user_ids, muted_until, reason)
+    banned_ids = [row['user_id'] for row in rows]
+    for user_id in user_ids:
+        _ban_cache.pop(user_id)
+    invalidate_bot_statistics()
+    return banned_ids
+
+
+async def remove_user_ban(pool, user_id: int) -> bool:
+    """
+    Lift a user's ban.
+    Returns True if the user was banned, False otherwise.
+    """
+    result = await pool.execute("DELETE FROM muted_users WHERE user_id = $1", user_id)
+    _ban_cache.pop(user_id)
+    invalidate_bot_statistics()
+    return result == "DELETE 1"
 
 
 async def is_user_admin(pool, user_id: int) -> bool:
     """Check if a user has admin privileges."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT is_admin FROM users WHERE user_id = $1", user_id)
-        return bool(row and row['is_admin'])
+    is_admin = _admin_flag_cache.get(user_id)
+    if is_admin is None:
+        # invalidate_admin_cache may run while the query does; don't cache over it
+        generation = _admin_flag_cache.generation(user_id)
+        async with pool.acquire() as conn:
+            is_admin = bool(await conn.hot['admin'].fetchval(user_id))
+        _admin_flag_cache.set_if_unchanged(user_id, is_admin, generation)
+    return is_admin
 
 
 async def is_user_premium(pool, user_id: int) -> bool:
@@ -429,40 +931,35 @@ async def is_user_premium(pool, user_id: int) -> bool:
     Check if a user has premium status.
     Returns True if user exists and is_premium is True, False otherwise.
     """
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT is_premium FROM users WHERE user_id = $1", user_id)
-        return bool(row and row['is_premium'])
+    row = await pool.fetchrow("SELECT is_premium FROM users WHERE user_id = $1", user_id)
+    return bool(row and row['is_premium'])
 
 
 async def get_all_admin_ids(pool):
-    """Get all admin user IDs."""
-    async with pool.acquire() as conn:
-        admin_ids = await conn.fetch("SELECT user_id FROM users WHERE is_admin = TRUE")
-        return [row['user_id'] for row in admin_ids]
+    """Get all admin user IDs (cached for ADMIN_IDS_TTL seconds)."""
+    if time.monotonic() < _admin_ids_cache['expires']:
+        return _admin_ids_cache['ids']
+
+    admin_ids = await pool.fetch("SELECT user_id FROM users WHERE is_admin = TRUE")
+    _admin_ids_cache['ids'] = [row['user_id'] for row in admin_ids]
+    _admin_ids_cache['expires'] = time.monotonic() + ADMIN_IDS_TTL
+    return _admin_ids_cache['ids']
+
+
+def invalidate_admin_cache():
+    """Drop cached admin IDs and flags; call after granting or revoking admin rights."""
+    _admin_ids_cache['expires'] = 0
+    _admin_flag_cache.clear()
 
 
 async def update_user_info(pool, user_id: int, username: str, name: str):
     """
     Update user's username and name in the database if they've changed.
     This should be called whenever we receive a message from a user to keep data up to date.
+    Unchanged rows (and unknown users) are filtered out server-side, so nothing is written.
     """
     async with pool.acquire() as conn:
-        # Check current values
-        current = await conn.fetchrow("""
-            SELECT username, name FROM users WHERE user_id = $1
-        """, user_id)
-        
-        if not current:
-            # User doesn't exist, nothing to update
-            return
-        
-        # Update if values have changed
-        if current['username'] != username or current['name'] != name:
-            await conn.execute("""
-                UPDATE users 
-                SET username = $1, name = $2 
-                WHERE user_id = $3
-            """, username, name, user_id)
+        await conn.hot['update_info'].fetchval(user_id, username, name)
 
 
 async def set_user_hidden(pool, user_id: int) -> bool:
@@ -470,23 +967,14 @@ async def set_user_hidden(pool, user_id: int) -> bool:
     Set is_hidden to True for a user. Only works if user is premium.
     Returns True if successful, False if user is not premium.
     """
-    async with pool.acquire() as conn:
-        # Check if user is premium
-        is_premium = await conn.fetchval("""
-            SELECT is_premium FROM users WHERE user_id = $1
-        """, user_id)
-        
-        if not is_premium:
-            return False
-        
-        # Update is_hidden to True
-        await conn.execute("""
-            UPDATE users 
-            SET is_hidden = TRUE
-            WHERE user_id = $1
-        """, user_id)
-        
-        return True
+    # Premium check and update in one statement, so premium can't lapse in between
+    updated = await pool.fetchval("""
+        UPDATE users 
+        SET is_hidden = TRUE
+        WHERE user_id = $1 AND is_premium = TRUE
+        RETURNING TRUE
+    """, user_id)
+    return bool(updated)
 
 
 async def notify_admins_new_user(pool, bot, new_user_id: int, username: str, name: str):
@@ -509,7 +997,7 @@ async def notify_admins_new_user(pool, bot, new_user_id: int, username: str, nam
             f"👤 <b>Ism:</b> {name}\n"
             f"🆔 <b>ID:</b> <code>{new_user_id}</code>\n"
             f"📱 <b>Username:</b> {username_text}\n"
-            f"📅 <b>Vaqt:</b> {datetime.now(ZoneInfo(TIMEZONE)).strftime('%Y-%m-%d %H:%M')}"
+            f"📅 <b>Vaqt:</b> {datetime.now(_TZ).strftime('%Y-%m-%d %H:%M')}"
         )
         
         # Try to create keyboard with profile link, but handle privacy restrictions
@@ -528,42 +1016,47 @@ async def notify_admins_new_user(pool, bot, new_user_id: int, username: str, nam
             ])
             has_profile_button = False
         
-        # Send notification to all admins
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=notification_text,
-                    parse_mode='HTML',
-                    reply_markup=keyboard
-                )
-            except TelegramBadRequest as e:
-                # If privacy restricted, try without profile button
-                error_str = str(e).upper()
-                if "BUTTON_USER_PRIVACY_RESTRICTED" in error_str or "PRIVACY_RESTRICTED" in error_str:
-                    if has_profile_button:
-                        # Retry without profile button
-                        keyboard_no_profile = InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="📊 Ma'lumotlarni ko'rish", callback_data=f"admin:select_user:{new_user_id}")]
-                        ])
-                        try:
-                            await bot.send_message(
-                                chat_id=admin_id,
-                                text=notification_text,
-                                parse_mode='HTML',
-                                reply_markup=keyboard_no_profile
-                            )
-                        except Exception as e2:
-                            print(f"Error notifying admin {admin_id}: {e2}")
+        # Send notification to all admins concurrently, bounded to respect Telegram flood limits
+        semaphore = asyncio.Semaphore(NOTIFY_ADMINS_CONCURRENCY)
+
+        async def notify_admin(admin_id: int):
+            async with semaphore:
+                try:
+                    await bot.send_message(
+                        chat_id=admin_id,
+                        text=notification_text,
+                        parse_mode='HTML',
+                        reply_markup=keyboard
+                    )
+                except TelegramBadRequest as e:
+                    # If privacy restricted, try without profile button
+                    error_str = str(e).upper()
+                    if "BUTTON_USER_PRIVACY_RESTRICTED" in error_str or "PRIVACY_RESTRICTED" in error_str:
+                        if has_profile_button:
+                            # Retry without profile button
+                            keyboard_no_profile = InlineKeyboardMarkup(inline_keyboard=[
+                                [InlineKeyboardButton(text="📊 Ma'lumotlarni ko'rish", callback_data=f"admin:select_user:{new_user_id}")]
+                            ])
+                            try:
+                                await bot.send_message(
+                                    chat_id=admin_id,
+                                    text=notification_text,
+                                    parse_mode='HTML',
+                                    reply_markup=keyboard_no_profile
+                                )
+                            except Exception as e2:
+                                logger.warning("Error notifying admin %s: %s", admin_id, e2)
+                        else:
+                            logger.warning("Error notifying admin %s: %s", admin_id, e)
                     else:
-                        print(f"Error notifying admin {admin_id}: {e}")
-                else:
-                    print(f"Error notifying admin {admin_id}: {e}")
-            except Exception as e:
-                # Log error but continue with other admins
-                print(f"Error notifying admin {admin_id}: {e}")
-    except Exception as e:
-        print(f"Error in notify_admins_new_user: {e}")
+                        logger.warning("Error notifying admin %s: %s", admin_id, e)
+                except Exception as e:
+                    # Log error but continue with other admins
+                    logger.warning("Error notifying admin %s: %s", admin_id, e)
+
+        await asyncio.gather(*(notify_admin(admin_id) for admin_id in admin_ids), return_exceptions=True)
+    except Exception:
+        logger.exception("Error in notify_admins_new_user")
 
 
 async def get_user_balance_info(pool, user_id: int):
@@ -571,16 +1064,15 @@ async def get_user_balance_info(pool, user_id: int):
     Get user's balance and total deposited amount.
     Returns (balance: float, total_deposited: float) or (None, None) if user doesn't exist.
     """
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT balance, total_deposited FROM users WHERE user_id = $1",
-            user_id
-        )
-        if row:
-            balance = float(row['balance']) if row['balance'] else 0.00
-            total_deposited = float(row['total_deposited']) if row['total_deposited'] else 0.00
-            return balance, total_deposited
-        return None, None
+    row = await pool.fetchrow(
+        "SELECT balance, total_deposited FROM users WHERE user_id = $1",
+        user_id
+    )
+    if row:
+        balance = float(row['balance']) if row['balance'] else 0.00
+        total_deposited = float(row['total_deposited']) if row['total_deposited'] else 0.00
+        return balance, total_deposited
+    return None, None
 
 
 async def get_user_premium_info(pool, user_id: int):
@@ -588,46 +1080,44 @@ async def get_user_premium_info(pool, user_id: int):
     Get user's premium status and subscription information.
     Returns dict with: is_premium, balance, subscription (if active), or None if user doesn't exist.
     """
-    async with pool.acquire() as conn:
-        # Get user info
-        user_row = await conn.fetchrow(
-            "SELECT is_premium, balance FROM users WHERE user_id = $1",
-            user_id
-        )
-
-        if not user_row:
-            return None
+    # User row and latest active subscription in one round trip
+    row = await pool.fetchrow("""
+        SELECT u.is_premium, u.balance, s.plan, s.start_date, s.end_date, s.is_active
+        FROM users u
+        LEFT JOIN LATERAL (
+            SELECT plan, start_date, end_date, is_active
+            FROM subscriptions
+            WHERE user_id = u.user_id AND is_active = TRUE
+            ORDER BY end_date DESC
+            LIMIT 1
+        ) s ON TRUE
+        WHERE u.user_id = $1
+    """, user_id)
 
-        is_premium = bool(user_row['is_premium'])
-        balance = float(user_row['balance']) if user_row['balance'] else 0.00
+    if not row:
+        return None
 
-        result = {
-            'is_premium': is_premium,
-            'balance': balance
+    is_premium = bool(row['is_premium'])
+    balance = float(row['balance']) if row['balance'] else 0.00
+
+    result = {
+        'is_premium': is_premium,
+        'balance': balance
+    }
+
+    # Active subscription is only reported for premium users
+    if is_premium and row['plan'] is not None:
+        result['subscription'] = {
+            'plan': row['plan'],
+            'start_date': row['start_date'],
+            'end_date': row['end_date'],
+            'is_active': bool(row['is_active'])
         }
 
-        # Get active subscription if premium
-        if is_premium:
-            subscription = await conn.fetchrow("""
-                SELECT plan, start_date, end_date, is_active
-                FROM subscriptions
-                WHERE user_id = $1 AND is_active = TRUE
-                ORDER BY end_date DESC
-                LIMIT 1
-            """, user_id)
-
-            if subscription:
-                result['subscription'] = {
-                    'plan': subscription['plan'],
-                    'start_date': subscription['start_date'],
-                    'end_date': subscription['end_date'],
-                    'is_active': bool(subscription['is_active'])
-                }
-
-        return result
+    return result
 
 
-async def get_plan_price(plan: str) -> float:
+def get_plan_price(plan: str) -> float:
     """Get price for a plan. Returns 0.0 if plan not found."""
     return PLAN_PRICES.get(plan, 0.0)
 
@@ -637,52 +1127,55 @@ async def create_payment(pool, user_id: int, amount: float, method: str, transac
     """
     Create a new payment record.
     method must be 'balance' (for internal subscription payments)
-    Returns payment ID or None if failed.
+    A duplicate transaction_id is rejected by the unique index, so no pre-check is needed.
+    Returns payment ID, or None if failed or transaction_id was already recorded.
     """
-    # Validate payment method - only 'balance' is allowed for new payments
-    if method != 'balance':
-        print(f"Invalid payment method: {method}. Only 'balance' is allowed for new payments.")
+    # Only 'balance' is allowed for new payments; enforced by the payments_method_balance trigger
+    try:
+        payment_id = await pool.fetchval("""
+            INSERT INTO payments (user_id, amount, method, status, transaction_id, merchant_data)
+            VALUES ($1, $2, $3, 'pending', $4, $5)
+            ON CONFLICT (transaction_id) WHERE transaction_id IS NOT NULL DO NOTHING
+            RETURNING id
+        """, user_id, amount, method, transaction_id, merchant_data)
+        if payment_id is None:
+            logger.info("Duplicate transaction_id ignored: %s", transaction_id)
+        return payment_id
+    except asyncpg.CheckViolationError:
+        logger.warning("Invalid payment method: %s. Only 'balance' is allowed for new payments.", method)
+        return None
+    except Exception:
+        logger.exception("Error creating payment")
         return None
-
-    async with pool.acquire() as conn:
-        try:
-            payment_id = await conn.fetchval("""
-                INSERT INTO payments (user_id, amount, method, status, transaction_id, merchant_data)
-                VALUES ($1, $2, $3::payment_method, 'pending', $4, $5)
-                RETURNING id
-            """, user_id, amount, method, transaction_id, merchant_data)
-            return payment_id
-        except Exception as e:
-            print(f"Error creating payment: {e}")
-            return None
 
 
 async def check_transaction_id_exists(pool, transaction_id: str) -> bool:
-    """Check if transaction_id already exists (prevent duplicate callbacks)."""
+    """
+    Check if transaction_id already exists.
+    Debug helper only: create_payment rejects duplicates itself via ON CONFLICT.
+    """
     if not transaction_id:
         return False
-    async with pool.acquire() as conn:
-        exists = await conn.fetchval("""
-            SELECT EXISTS(SELECT 1 FROM payments WHERE transaction_id = $1)
-        """, transaction_id)
-        return bool(exists)
+    exists = await pool.fetchval("""
+        SELECT EXISTS(SELECT 1 FROM payments WHERE transaction_id = $1)
+    """, transaction_id)
+    return bool(exists)
 
 
 async def update_payment_status(pool, payment_id: int, status: str, transaction_id: str = None):
     """Update payment status."""
-    async with pool.acquire() as conn:
-        if transaction_id:
-            await conn.execute("""
-                UPDATE payments 
-                SET status = $1, transaction_id = $2 
-                WHERE id = $3
-            """, status, transaction_id, payment_id)
-        else:
-            await conn.execute("""
-                UPDATE payments 
-                SET status = $1 
-                WHERE id = $2
-            """, status, payment_id)
+    if transaction_id:
+        await pool.execute("""
+            UPDATE payments 
+            SET status = $1, transaction_id = $2 
+            WHERE id = $3
+        """, status, transaction_id, payment_id)
+    else:
+        await pool.execute("""
+            UPDATE payments 
+            SET status = $1 
+            WHERE id = $2
+        """, status, payment_id)
 
 
 async def update_user_balance(pool, user_id: int, amount: float, add_to_total: bool = False):
@@ -691,24 +1184,23 @@ async def update_user_balance(pool, user_id: int, amount: float, add_to_total: b
     If add_to_total is True, also add to total_deposited.
     Returns True if successful.
     """
-    async with pool.acquire() as conn:
-        try:
-            if add_to_total:
-                await conn.execute("""
-                    UPDATE users 
-                    SET balance = balance + $1, total_deposited = total_deposited + $1 
-                    WHERE user_id = $2
-                """, amount, user_id)
-            else:
-                await conn.execute("""
-                    UPDATE users 
-                    SET balance = balance + $1 
-                    WHERE user_id = $2
-                """, amount, user_id)
-            return True
-        except Exception as e:
-            print(f"Error updating user balance: {e}")
-            return False
+    try:
+        if add_to_total:
+            await pool.execute("""
+                UPDATE users 
+                SET balance = balance + $1, total_deposited = total_deposited + $1 
+                WHERE user_id = $2
+            """, amount, user_id)
+        else:
+            await pool.execute("""
+                UPDATE users 
+                SET balance = balance + $1 
+                WHERE user_id = $2
+            """, amount, user_id)
+        return True
+    except Exception:
+        logger.exception("Error updating user balance")
+        return False
 
 
 async def activate_subscription(pool, user_id: int, plan: str):
@@ -721,89 +1213,57 @@ async def activate_subscription(pool, user_id: int, plan: str):
     if plan not in VALID_PLANS:
         return False, None
 
-    from datetime import timedelta
-
-    async with pool.acquire() as conn:
-        try:
-            current_time = datetime.now(ZoneInfo(TIMEZONE)).replace(tzinfo=None)
-
-            # Calculate days to add based on plan
-            if plan == '1_month':
-                days_to_add = 30
-            elif plan == '3_months':
-                days_to_add = 90
-            elif plan == '6_months':
-                days_to_add = 180
-            elif plan == '1_year':
-                days_to_add = 365
-            else:
-                return False, None
-
-            # Check if user has active subscription
-            active_sub = await conn.fetchrow("""
-                SELECT id, end_date 
-                FROM subscriptions 
-                WHERE user_id = $1 AND is_active = TRUE 
-                ORDER BY end_date DESC 
-                LIMIT 1
-            """, user_id)
-
-            if active_sub:
-                # Extend existing subscription
-                existing_end_date = active_sub['end_date']
-                
-                # Ensure both datetimes are timezone-naive for comparison
-                if existing_end_date.tzinfo is not None:
-                    existing_end_date = existing_end_date.replace(tzinfo=None)
-
-                # If subscription hasn't expired, extend from end_date, otherwise from now
-                if existing_end_date > current_time:
-                    new_end_date = existing_end_date + timedelta(days=days_to_add)
-                    start_date = existing_end_date
-                else:
-                    new_end_date = current_time + timedelta(days=days_to_add)
-                    start_date = current_time
-
-                # Update existing subscription
-                await conn.execute("""
-                    UPDATE subscriptions 
-                    SET plan = $1, end_date = $2, start_date = $3
-                    WHERE id = $4
-                """, plan, new_end_date.replace(tzinfo=None), start_date.replace(tzinfo=None), active_sub['id'])
-
-                subscription_id = active_sub['id']
-            else:
-                # Create new subscription
-                start_date = current_time
-                end_date = start_date + timedelta(days=days_to_add)
-
-                subscription_id = await conn.fetchval("""
-                    INSERT INTO subscriptions (user_id, plan, start_date, end_date, is_active)
-                    VALUES ($1, $2, $3, $4, TRUE)
-                    RETURNING id
-                """, user_id, plan, start_date.replace(tzinfo=None), end_date.replace(tzinfo=None))
-
-            # Set user as premium
-            await conn.execute("""
+    try:
+        # One statement: upsert on the single active subscription (subs_one_active),
+        # extending from end_date if it hasn't expired yet, otherwise from now
+        subscription_id = await pool.fetchval("""
+            WITH sub AS (
+                INSERT INTO subscriptions (user_id, plan, start_date, end_date, is_active)
+                VALUES ($1, $2, LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(days => $3), TRUE)
+                ON CONFLICT (user_id) WHERE is_active DO UPDATE
+                SET plan = EXCLUDED.plan,
+                    start_date = GREATEST(subscriptions.end_date, LOCALTIMESTAMP),
+                    end_date = GREATEST(subscriptions.end_date, LOCALTIMESTAMP) + make_interval(days => $3)
+                RETURNING id
+            ), premium AS (
                 UPDATE users 
                 SET is_premium = TRUE 
                 WHERE user_id = $1
-            """, user_id)
+            )
+            SELECT id FROM sub
+        """, user_id, plan, PLAN_DAYS[plan])
 
-            return True, subscription_id
-        except Exception as e:
-            print(f"Error activating subscription: {e}")
-            return False, None
+        return True, subscription_id
+    except Exception:
+        logger.exception("Error activating subscription")
+        return False, None
 
 
 async def log_message(pool, sender_id, receiver_id, text):
-    """Log a message to the message_log table with Tashkent timezone."""
-    tashkent_time = datetime.now(ZoneInfo(TIMEZONE)).replace(tzinfo=None)
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO message_log (sender_id, receiver_id, message, sent_at)
-            VALUES ($1, $2, $3, $4)
-        """, sender_id, receiver_id, text, tashkent_time)
+    """
+    Log a message to the message_log table.
+    The row is queued and written in a batch by the message log writer; sent_at is
+    stamped by the column default at write time (pool sessions run in TIMEZONE).
+    """
+    row = (sender_id, receiver_id, text)
+    if _message_log_writer is not None:
+        _message_log_writer.put(row)
+    else:
+        await log_messages_bulk(pool, [row])
+
+
+async def log_messages_bulk(pool, rows):
+    """
+    Insert many message_log rows in one COPY.
+    rows is a list of (sender_id, receiver_id, message) tuples.
+    """
+    # COPY instead of INSERT: no per-batch parse/plan and a compact binary row format.
+    # sent_at is left to its CURRENT_TIMESTAMP default.
+    await pool.copy_records_to_table(
+        'message_log',
+        records=rows,
+        columns=('sender_id', 'receiver_id', 'message')
+    )
 
 
 async def generate_referral_code(pool, user_id: int) -> str:
@@ -811,49 +1271,34 @@ async def generate_referral_code(pool, user_id: int) -> str:
     Generate a unique referral code for a user.
     Returns existing code if user already has one, otherwise generates new.
     """
-    import secrets
-    import string
-    
-    async with pool.acquire() as conn:
-        # Check if user already has a referral code
-        existing_code = await conn.fetchval("""
-            SELECT referral_code FROM users WHERE user_id = $1
-        """, user_id)
-        
-        if existing_code:
-            return existing_code
-        
+    while True:
         # Generate new unique code (8 characters, alphanumeric uppercase)
-        while True:
-            code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
-            # Check if code already exists
-            exists = await conn.fetchval("""
-                SELECT EXISTS(SELECT 1 FROM users WHERE referral_code = $1)
-            """, code)
-            if not exists:
-                # Save the code
-                await conn.execute("""
-                    UPDATE users SET referral_code = $1 WHERE user_id = $2
-                """, code, user_id)
-                return code
+        code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+        try:
+            # COALESCE keeps an existing code, so the common path is one round trip;
+            # the UNIQUE constraint on referral_code rejects the rare collision
+            return await pool.fetchval("""
+                UPDATE users SET referral_code = COALESCE(referral_code, $1)
+                WHERE user_id = $2
+                RETURNING referral_code
+            """, code, user_id)
+        except asyncpg.UniqueViolationError:
+            continue
 
 
 async def get_user_referral_code(pool, user_id: int) -> str | None:
     """Get user's referral code. Returns None if not exists."""
-    async with pool.acquire() as conn:
-        code = await conn.fetchval("""
-            SELECT referral_code FROM users WHERE user_id = $1
-        """, user_id)
-        return code
+    code = await pool.fetchval("""
+        SELECT referral_code FROM users WHERE user_id = $1
+    """, user_id)
+    return code
 
 
 async def get_user_by_referral_code(pool, referral_code: str):
-    """Get user by referral code. Returns user dict or None."""
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("""
-            SELECT user_id, username, name FROM users WHERE referral_code = $1
-        """, referral_code)
-        return dict(user) if user else None
+    """Get user by referral code. Returns user record or None."""
+    return await pool.fetchrow("""
+        SELECT user_id, username, name FROM users WHERE referral_code = $1
+    """, referral_code)
 
 
 async def process_referral(pool, new_user_id: int, referral_code: str, bot=None) -> bool:
@@ -861,69 +1306,50 @@ async def process_referral(pool, new_user_id: int, referral_code: str, bot=None)
     Process a referral when a new user joins via referral code.
     Returns True if referral was processed, False if user already existed or invalid code.
     """
-    async with pool.acquire() as conn:
-        # Check if user already exists (was created before)
-        user_exists = await conn.fetchval("""
-            SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)
-        """, new_user_id)
-        
-        # Get user info to check if they're new
-        user_info = await conn.fetchrow("""
-            SELECT created_at, referral_by FROM users WHERE user_id = $1
-        """, new_user_id)
-        
-        if not user_info:
-            # User doesn't exist - shouldn't happen if called after get_or_create_user
-            return False
-        
-        # If user already has a referrer, don't process (prevent duplicate)
-        if user_info['referral_by']:
-            return False
-        
-        # Check if user was created more than a minute ago (not a new referral)
-        from datetime import datetime, timedelta
-        if user_info['created_at']:
-            time_diff = datetime.now() - user_info['created_at']
-            if time_diff > timedelta(minutes=1):
-                # User was created before, not a new referral
-                return False
-        
-        # Get referrer by code
-        referrer = await get_user_by_referral_code(pool, referral_code)
-        if not referrer:
-            return False
-        
-        referrer_id = referrer['user_id']
-        
-        # Don't allow self-referral
-        if referrer_id == new_user_id:
-            return False
-        
-        # Set referral_by for new user
-        await conn.execute("""
-            UPDATE users SET referral_by = $1 WHERE user_id = $2
-        """, referrer_id, new_user_id)
-        
-        # Add 10 soums to referrer's balance
-        await update_user_balance(pool, referrer_id, 10.00, add_to_total=False)
-        
-        # Send notification to referrer if bot is provided
-        if bot:
-            try:
-                referrer_name = referrer.get('name', 'Foydalanuvchi')
-                balance, _ = await get_user_balance_info(pool, referrer_id)
-                await bot.send_message(
-                    chat_id=referrer_id,
-                    text=f"🎉 <b>Referral bonus!</b>\n\n"
-                         f"✅ Sizning taklif havolangiz orqali yangi foydalanuvchi qo'shildi.\n"
-                         f"💰 Balansingizga <b>+10 so'm</b> qo'shildi!\n\n"
-                         f"💵 Joriy balans: {balance or 0.00:.2f} so'm",
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                print(f"Error sending referral notification: {e}")
-        
-        return True
+    # One statement: resolve the referrer, set referral_by only for a user created within
+    # the last minute who has no referrer yet (no self-referral), and credit the bonus
+    # along with the referrer's denormalized referral stats.
+    # The referral_by IS NULL check is re-evaluated under the row lock, so a referral
+    # can't be credited twice.
+    row = await pool.fetchrow("""
+        WITH referrer AS (
+            SELECT user_id FROM users WHERE referral_code = $2 AND user_id <> $1
+        ), referred AS (
+            UPDATE users 
+            SET referral_by = referrer.user_id
+            FROM referrer
+            WHERE users.user_id = $1
+              AND users.referral_by IS NULL
+              AND (users.created_at IS NULL OR users.created_at > LOCALTIMESTAMP - INTERVAL '1 minute')
+            RETURNING referrer.user_id AS referrer_id
+        )
+        UPDATE users 
+        SET balance = balance + $3,
+            referral_count = referral_count + 1,
+            referral_earnings = referral_earnings + $3
+        WHERE user_id IN (SELECT referrer_id FROM referred)
+        RETURNING user_id, balance
+    """, new_user_id, referral_code, REFERRAL_BONUS)
+
+    if not row:
+        return False
+
+    # Send notification to referrer if bot is provided
+    if bot:
+        try:
+            balance = float(row['balance']) if row['balance'] else 0.00
+            await bot.send_message(
+                chat_id=row['user_id'],
+                text=f"🎉 <b>Referral bonus!</b>\n\n"
+                     f"✅ Sizning taklif havolangiz orqali yangi foydalanuvchi qo'shildi.\n"
+                     f"💰 Balansingizga <b>+10 so'm</b> qo'shildi!\n\n"
+                     f"💵 Joriy balans: {balance:.2f} so'm",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.warning("Error sending referral notification: %s", e)
+
+    return True
 
 
 async def get_user_referral_stats(pool, user_id: int):
@@ -931,52 +1357,40 @@ async def get_user_referral_stats(pool, user_id: int):
     Get referral statistics for a user.
     Returns: (referral_count: int, referral_earnings: float, referral_code: str | None, referred_by: int | None, referrer_name: str | None)
     """
-    async with pool.acquire() as conn:
-        # Get referral code
-        referral_code = await conn.fetchval("""
-            SELECT referral_code FROM users WHERE user_id = $1
-        """, user_id)
-        
-        # Count how many users this user referred
-        referral_count = await conn.fetchval("""
-            SELECT COUNT(*) FROM users WHERE referral_by = $1
-        """, user_id)
-        
-        # Calculate earnings from referrals (10 soums per referral)
-        referral_earnings = referral_count * 10.00
-        
-        # Get who referred this user
-        referred_by_info = await conn.fetchrow("""
-            SELECT referral_by FROM users WHERE user_id = $1
-        """, user_id)
-        
-        referred_by = referred_by_info['referral_by'] if referred_by_info and referred_by_info['referral_by'] else None
-        
-        # Get referrer name if exists
-        referrer_name = None
-        if referred_by:
-            referrer_info = await conn.fetchrow("""
-                SELECT name FROM users WHERE user_id = $1
-            """, referred_by)
-            referrer_name = referrer_info['name'] if referrer_info else None
-        
-        return referral_count, referral_earnings, referral_code, referred_by, referrer_name
+    row = await pool.fetchrow("""
+        SELECT 
+            u.referral_code,
+            u.referral_by,
+            u.referral_count,
+            u.referral_earnings,
+            r.name AS referrer_name
+        FROM users u
+        LEFT JOIN users r ON r.user_id = u.referral_by
+        WHERE u.user_id = $1
+    """, user_id)
+
+    if not row:
+        return 0, 0.00, None, None, None
+
+    referral_count = row['referral_count'] or 0
+    referral_earnings = float(row['referral_earnings']) if row['referral_earnings'] else 0.00
+
+    return referral_count, referral_earnings, row['referral_code'], row['referral_by'], row['referrer_name']
 
 
 async def get_user_payment_history(pool, user_id: int, limit: int = 20):
     """
     Get payment history for a user.
-    Returns list of payment records.
+    Returns list of payment records (asyncpg Records, subscriptable by column name).
     """
-    async with pool.acquire() as conn:
-        payments = await conn.fetch("""
-            SELECT id, amount, method, status, transaction_id, merchant_data, created_at
-            FROM payments
-            WHERE user_id = $1
-            ORDER BY created_at DESC
-            LIMIT $2
-        """, user_id, limit)
-        return [dict(payment) for payment in payments]
+    payments = await pool.fetch("""
+        SELECT id, amount, method, status, transaction_id, merchant_data, created_at
+        FROM payments
+        WHERE user_id = $1
+        ORDER BY created_at DESC
+        LIMIT $2
+    """, user_id, limit)
+    return payments
 
 
 async def get_user_full_info(pool, user_id: int):
@@ -984,48 +1398,62 @@ async def get_user_full_info(pool, user_id: int):
     Get comprehensive user information for admin panel.
     Returns dict with all user details.
     """
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("""
-            SELECT 
-                user_id, username, name, is_admin, is_superuser, is_premium,
-                balance, total_deposited, referral_code, referral_by, created_at
-            FROM users 
-            WHERE user_id = $1
-        """, user_id)
-        
-        if not user:
-            return None
-        
-        user_dict = dict(user)
-        
-        # Get subscription info
-        subscription = await conn.fetchrow("""
+    # User, active subscription, last activity, referral stats, ban and chat state in one round trip
+    row = await pool.fetchrow("""
+        SELECT 
+            u.user_id, u.username, u.name, u.is_admin, u.is_superuser, u.is_premium,
+            u.balance, u.total_deposited, u.referral_code, u.referral_by, u.created_at,
+            s.plan AS sub_plan, s.start_date AS sub_start_date,
+            s.end_date AS sub_end_date, s.is_active AS sub_is_active,
+            (SELECT sent_at FROM message_log
+             WHERE sender_id = u.user_id
+             ORDER BY sent_at DESC
+             LIMIT 1) AS last_activity,
+            u.referral_count, u.referral_earnings,
+            r.name AS referrer_name,
+            EXISTS (SELECT 1 FROM muted_users
+                    WHERE user_id = u.user_id AND muted_until > LOCALTIMESTAMP) AS is_banned,
+            (SELECT user2_id FROM chat_connections WHERE user1_id = u.user_id
+             UNION ALL
+             SELECT user1_id FROM chat_connections WHERE user2_id = u.user_id
+             LIMIT 1) AS partner_id
+        FROM users u
+        LEFT JOIN LATERAL (
             SELECT plan, start_date, end_date, is_active
             FROM subscriptions
-            WHERE user_id = $1 AND is_active = TRUE
+            WHERE user_id = u.user_id AND is_active = TRUE
             ORDER BY end_date DESC
             LIMIT 1
-        """, user_id)
-        
-        user_dict['subscription'] = dict(subscription) if subscription else None
-        
-        # Get activity info (last message sent, last login, etc.)
-        last_message = await conn.fetchrow("""
-            SELECT sent_at FROM message_log
-            WHERE sender_id = $1
-            ORDER BY sent_at DESC
-            LIMIT 1
-        """, user_id)
-        
-        user_dict['last_activity'] = last_message['sent_at'] if last_message else None
-        
-        # Get referral stats
-        referral_count, referral_earnings, referral_code, referred_by, referrer_name = await get_user_referral_stats(pool, user_id)
-        user_dict['referral_count'] = referral_count
-        user_dict['referral_earnings'] = referral_earnings
-        user_dict['referrer_name'] = referrer_name
-        
-        return user_dict
+        ) s ON TRUE
+        LEFT JOIN users r ON r.user_id = u.referral_by
+        WHERE u.user_id = $1
+    """, user_id)
+
+    if not row:
+        return None
+
+    user_dict = {
+        key: row[key] for key in (
+            'user_id', 'username', 'name', 'is_admin', 'is_superuser', 'is_premium',
+            'balance', 'total_deposited', 'referral_code', 'referral_by', 'created_at'
+        )
+    }
+
+    user_dict['subscription'] = {
+        'plan': row['sub_plan'],
+        'start_date': row['sub_start_date'],
+        'end_date': row['sub_end_date'],
+        'is_active': row['sub_is_active']
+    } if row['sub_plan'] is not None else None
+
+    user_dict['last_activity'] = row['last_activity']
+    user_dict['referral_count'] = row['referral_count'] or 0
+    user_dict['referral_earnings'] = float(row['referral_earnings']) if row['referral_earnings'] else 0.00
+    user_dict['referrer_name'] = row['referrer_name']
+    user_dict['is_banned'] = row['is_banned']
+    user_dict['partner_id'] = row['partner_id']
+
+    return user_dict
 
 
 async def get_or_create_user(pool, user_id: int, username: str, name: str, referral_code: str = None):
@@ -1035,32 +1463,23 @@ async def get_or_create_user(pool, user_id: int, username: str, name: str, refer
     Also updates username and name if they've changed.
     Returns (token: str, is_new_user: bool).
     """
-    from utils import generate_token
-
+    # Token for the new-user case is generated up front; an existing row keeps its own.
+    # Note: Don't set referral_by here - let process_referral handle it
+    # This ensures the bonus is properly added and notification is sent
+    token = generate_token()
+
+    # Insert, update changed username/name, or just read the token - all in one round trip.
+    # xmax = 0 only for freshly inserted rows; the UNION ALL branch covers unchanged rows,
+    # for which the conditional DO UPDATE returns nothing.
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT token, referral_by, username, name FROM users WHERE user_id = $1", user_id)
-        if row:
-            # User exists - update username and name if changed
-            if row['username'] != username or row['name'] != name:
-                await conn.execute("""
-                    UPDATE users 
-                    SET username = $1, name = $2 
-                    WHERE user_id = $3
-                """, username, name, user_id)
-            return row["token"], False
-        else:
-            # New user - create them
-            # Note: Don't set referral_by here - let process_referral handle it
-            # This ensures the bonus is properly added and notification is sent
-            token = generate_token()
-            tashkent_time = datetime.now(ZoneInfo(TIMEZONE)).replace(tzinfo=None)
-            
-            await conn.execute(
-                "INSERT INTO users (user_id, username, name, token, created_at) VALUES ($1, $2, $3, $4, $5)",
-                user_id, username, name, token, tashkent_time
-            )
-            
-            return token, True
+        row = await conn.hot['get_or_create_user'].fetchrow(user_id, username, name, token)
+
+    if row is None:
+        # Row was inserted concurrently after this statement's snapshot was taken
+        existing_token = await pool.fetchval("SELECT token FROM users WHERE user_id = $1", user_id)
+        return existing_token, False
+
+    return row["token"], row["is_new"]
 
 
 # Chat-related database functions
@@ -1069,12 +1488,9 @@ async def add_to_chat_queue(pool, user_id: int):
     """Add user to the chat queue if not already in queue or in an active chat."""
     async with pool.acquire() as conn:
         # Check if user is already in a chat
-        active_chat = await conn.fetchrow("""
-            SELECT user1_id, user2_id FROM chat_connections 
-            WHERE user1_id = $1 OR user2_id = $1
-        """, user_id)
+        active_chat = await conn.hot['partner'].fetchval(user_id)
 
-        if active_chat:
+        if active_chat is not None:
             return False, "already_in_chat"
 
         # Check if user is already in queue
@@ -1089,45 +1505,57 @@ async def add_to_chat_queue(pool, user_id: int):
 
 async def find_chat_partner(pool, user_id: int):
     """
-    Find a random chat partner for the user from the queue.
+    Find a chat partner for the user from the queue (longest-waiting first).
     Returns (found: bool, partner_id: int | None)
     """
-    async with pool.acquire() as conn:
-        # Get a random user from queue (excluding current user)
-        partner = await conn.fetchrow("""
-            SELECT user_id FROM chat_queue 
-            WHERE user_id != $1 
-            ORDER BY RANDOM() 
+    # One statement: lock the caller's own queue row, then the longest-waiting partner,
+    # dequeue both and open the connection. Both locks use SKIP LOCKED, so a queue row
+    # belongs to at most one matcher. A caller who already left the queue, or whose row
+    # another matcher is pairing right now, gets no match; two users matching at the
+    # same moment may skip each other and stay queued for the next arrival.
+    # The EXISTS guard keeps the user queued when nobody else is waiting.
+    partner_id = await pool.fetchval("""
+        WITH me AS (
+            SELECT user_id FROM chat_queue
+            WHERE user_id = $1
+            FOR UPDATE SKIP LOCKED
+        ), picked AS (
+            SELECT user_id FROM chat_queue
+            WHERE user_id != $1 AND EXISTS (SELECT 1 FROM me)
+            ORDER BY joined_at
             LIMIT 1
-        """, user_id)
-
-        if partner:
-            partner_id = partner["user_id"]
-            # Remove both users from queue
-            await conn.execute("DELETE FROM chat_queue WHERE user_id IN ($1, $2)", user_id, partner_id)
-            # Create chat connection
-            await conn.execute("""
-                INSERT INTO chat_connections (user1_id, user2_id) 
-                VALUES ($1, $2)
-            """, user_id, partner_id)
-            return True, partner_id
+            FOR UPDATE SKIP LOCKED
+        ), dequeued AS (
+            DELETE FROM chat_queue
+            WHERE user_id IN ($1, (SELECT user_id FROM picked))
+              AND EXISTS (SELECT 1 FROM picked)
+        )
+        INSERT INTO chat_connections (user1_id, user2_id)
+        SELECT me.user_id, picked.user_id FROM me, picked
+        RETURNING user2_id AS partner_id
+    """, user_id)
 
+    if partner_id is None:
         return False, None
 
+    # Committed; both sides can now be served from the partner cache
+    _partner_cache.set(user_id, partner_id)
+    _partner_cache.set(partner_id, user_id)
+    return True, partner_id
+
 
 async def get_chat_partner(pool, user_id: int):
     """Get the chat partner ID for a user. Returns partner_id or None."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT 
-                CASE 
-                    WHEN user1_id = $1 THEN user2_id 
-                    ELSE user1_id 
-                END as partner_id
-            FROM chat_connections 
-            WHERE user1_id = $1 OR user2_id = $1
-        """, user_id)
-        return row["partner_id"] if row else None
+    partner_id = _partner_cache.get(user_id, _MISSING)
+    if partner_id is _MISSING:
+        # end_chat / find_chat_partner may update the entry while the query runs;
+        # the generation check keeps this (possibly older) result from overwriting theirs
+        generation = _partner_cache.generation(user_id)
+        # Two single-column lookups instead of an OR, so each side uses its own index
+        async with pool.acquire() as conn:
+            partner_id = await conn.hot['partner'].fetchval(user_id)
+        _partner_cache.set_if_unchanged(user_id, partner_id, generation)
+    return partner_id
 
 
 async def end_chat(pool, user_id: int):
@@ -1135,114 +1563,221 @@ async def end_chat(pool, user_id: int):
     End chat for a user and their partner.
     Returns (ended: bool, partner_id: int | None)
     """
-    async with pool.acquire() as conn:
-        # Get partner
-        partner_row = await conn.fetchrow("""
-            SELECT 
-                CASE 
-                    WHEN user1_id = $1 THEN user2_id 
-                    ELSE user1_id 
-                END as partner_id
-            FROM chat_connections 
-            WHERE user1_id = $1 OR user2_id = $1
-        """, user_id)
-
-        if partner_row:
-            partner_id = partner_row["partner_id"]
-            # Delete chat connection
-            await conn.execute("""
-                DELETE FROM chat_connections 
-                WHERE (user1_id = $1 AND user2_id = $2) OR (user1_id = $2 AND user2_id = $1)
-            """, user_id, partner_id)
-            return True, partner_id
+    # One statement: delete the connection and learn the partner from the deleted row
+    partner_id = await pool.fetchval("""
+        DELETE FROM chat_connections
+        WHERE user1_id = $1 OR user2_id = $1
+        RETURNING CASE WHEN user1_id = $1 THEN user2_id ELSE user1_id END AS partner_id
+    """, user_id)
 
-        return False, None
+    _partner_cache.pop(user_id)
+    if partner_id is not None:
+        _partner_cache.pop(partner_id)
+        return True, partner_id
+    return False, None
 
 
 async def remove_from_chat_queue(pool, user_id: int):
     """Remove user from chat queue."""
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM chat_queue WHERE user_id = $1", user_id)
+    await pool.execute("DELETE FROM chat_queue WHERE user_id = $1", user_id)
 
 
 # Admin-related database functions
 
 async def get_all_active_chats(pool):
     """Get all active chat connections with user information."""
-    async with pool.acquire() as conn:
-        chats = await conn.fetch("""
-            SELECT 
-                cc.id,
-                cc.user1_id,
-                cc.user2_id,
-                cc.created_at,
-                u1.name as user1_name,
-                u2.name as user2_name
-            FROM chat_connections cc
-            LEFT JOIN users u1 ON cc.user1_id = u1.user_id
-            LEFT JOIN users u2 ON cc.user2_id = u2.user_id
-            ORDER BY cc.created_at DESC
-        """)
-        return chats
+    chats = await pool.fetch("""
+        SELECT 
+            cc.id,
+            cc.user1_id,
+            cc.user2_id,
+            cc.created_at,
+            u1.name as user1_name,
+            u2.name as user2_name
+        FROM chat_connections cc
+        LEFT JOIN users u1 ON cc.user1_id = u1.user_id
+        LEFT JOIN users u2 ON cc.user2_id = u2.user_id
+        ORDER BY cc.created_at DESC
+    """)
+    return chats
 
 
 async def get_chat_message_count(pool, user1_id: int, user2_id: int):
     """Get message count between two users in message_log."""
-    async with pool.acquire() as conn:
-        count = await conn.fetchval("""
-            SELECT COUNT(*) FROM message_log
-            WHERE (sender_id = $1 AND receiver_id = $2) 
-               OR (sender_id = $2 AND receiver_id = $1)
-        """, user1_id, user2_id)
-        return count or 0
+    # Direction-independent pair key, matching message_log_pair_idx
+    count = await pool.fetchval("""
+        SELECT COUNT(*) FROM message_log
+        WHERE LEAST(sender_id, receiver_id) = LEAST($1::bigint, $2::bigint)
+          AND GREATEST(sender_id, receiver_id) = GREATEST($1::bigint, $2::bigint)
+    """, user1_id, user2_id)
+    return count or 0
 
 
 async def get_all_banned_users(pool):
     """Get all banned users with their information."""
-    async with pool.acquire() as conn:
-        banned = await conn.fetch("""
-            SELECT 
-                mu.user_id,
-                mu.muted_until,
-                mu.reason,
-                mu.created_at,
-                u.name,
-                u.username
-            FROM muted_users mu
-            LEFT JOIN users u ON mu.user_id = u.user_id
-            WHERE mu.muted_until > CURRENT_TIMESTAMP
-            ORDER BY mu.muted_until DESC
-        """)
-        return banned
+    banned = await pool.fetch("""
+        SELECT 
+            mu.user_id,
+            mu.muted_until,
+            mu.reason,
+            mu.created_at,
+            u.name,
+            u.username
+        FROM muted_users mu
+        LEFT JOIN users u ON mu.user_id = u.user_id
+        WHERE mu.muted_until > LOCALTIMESTAMP
+        ORDER BY mu.muted_until DESC
+    """)
+    return banned
 
 
 async def get_banned_users_count(pool):
     """Get count of currently banned users."""
-    async with pool.acquire() as conn:
-        count = await conn.fetchval("""
-            SELECT COUNT(*) FROM muted_users
-            WHERE muted_until > CURRENT_TIMESTAMP
-        """)
-        return count or 0
+    count = await pool.fetchval("""
+        SELECT COUNT(*) FROM muted_users
+        WHERE muted_until > LOCALTIMESTAMP
+    """)
+    return count or 0
+
+
+async def get_recent_users(pool, limit: int, cursor: tuple[datetime, int] = None, backwards: bool = False):
+    """
+    Get a page of users, newest first, using keyset pagination on (created_at, user_id).
+    cursor is the (created_at, user_id) of the row next to the wanted page: the last row of
+    the previous page, or with backwards=True the first row of the following page.
+    Returns (users: list[Record], has_more: bool); has_more tells whether more rows exist
+    beyond the page in the direction of travel.
+    """
+    # One extra row tells whether another page exists; served by users_created_at_idx
+    if cursor is None:
+        users = await pool.fetch("""
+            SELECT user_id, name, created_at FROM users
+            ORDER BY created_at DESC, user_id DESC
+            LIMIT $1
+        """, limit + 1)
+    elif not backwards:
+        users = await pool.fetch("""
+            SELECT user_id, name, created_at FROM users
+            WHERE (created_at, user_id) < ($1, $2)
+            ORDER BY created_at DESC, user_id DESC
+            LIMIT $3
+        """, *cursor, limit + 1)
+    else:
+        users = await pool.fetch("""
+            SELECT user_id, name, created_at FROM users
+            WHERE (created_at, user_id) > ($1, $2)
+            ORDER BY created_at, user_id
+            LIMIT $3
+        """, *cursor, limit + 1)
+
+    has_more = len(users) > limit
+    users = users[:limit]
+    if backwards:
+        users.reverse()
+    return users, has_more
+
+
+async def count_broadcast_users(pool, non_premium_only: bool = False) -> int:
+    """Count the users a broadcast will be sent to."""
+    if non_premium_only:
+        return await pool.fetchval("SELECT COUNT(*) FROM users WHERE is_premium = FALSE")
+    return await pool.fetchval("SELECT value FROM bot_counters WHERE name = 'users'")
+
+
+async def iter_broadcast_user_ids(pool, non_premium_only: bool = False, batch_size: int = 500):
+    """
+    Yield broadcast recipients as lists of at most batch_size user IDs.
+    Pages by user_id (keyset) so only one batch is in memory and no connection or
+    transaction is held while the caller sends messages.
+    """
+    last_id = 0
+    while True:
+        rows = await pool.fetch("""
+            SELECT user_id FROM users
+            WHERE user_id > $1 AND ($2 = FALSE OR is_premium = FALSE)
+            ORDER BY user_id
+            LIMIT $3
+        """, last_id, non_premium_only, batch_size)
+        if not rows:
+            return
+        user_ids = [row['user_id'] for row in rows]
+        yield user_ids
+        if len(user_ids) < batch_size:
+            return
+        last_id = user_ids[-1]
+
+
+async def get_bot_statistics(pool):
+    """
+    Get the admin statistics panel counts in one round trip (cached for STATS_CACHE_TTL seconds).
+    Returns a record with total_users, today_users, month_users, active_chats, banned and queue.
+    """
+    if time.monotonic() < _stats_cache['expires']:
+        return _stats_cache['data']
+
+    # Concurrent refreshes wait for the first one instead of each running the counts
+    async with _stats_lock:
+        if time.monotonic() < _stats_cache['expires']:
+            return _stats_cache['data']
+        _stats_cache['data'] = await _fetch_bot_statistics(pool)
+        _stats_cache['expires'] = time.monotonic() + STATS_CACHE_TTL
+    return _stats_cache['data']
+
+
+def invalidate_bot_statistics():
+    """Drop the cached statistics; call after admin actions whose effect the panel should show at once."""
+    _stats_cache['expires'] = 0
+
+
+async def _fetch_bot_statistics(pool):
+    # Day/month boundaries come from LOCALTIMESTAMP, i.e. TIMEZONE (the pool's session timezone).
+    # total_users comes from the trigger-maintained bot_counters row (see _migrate_schema).
+    return await pool.fetchrow("""
+        SELECT
+            (SELECT value FROM bot_counters WHERE name = 'users') AS total_users,
+            (SELECT COUNT(*) FROM users
+             WHERE created_at >= date_trunc('day', LOCALTIMESTAMP)) AS today_users,
+            (SELECT COUNT(*) FROM users
+             WHERE created_at >= date_trunc('month', LOCALTIMESTAMP)) AS month_users,
+            (SELECT COUNT(*) FROM chat_connections) AS active_chats,
+            (SELECT COUNT(*) FROM muted_users WHERE muted_until > LOCALTIMESTAMP) AS banned,
+            (SELECT COUNT(*) FROM chat_queue) AS queue
+    """)
 
 
 async def admin_end_chat_by_id(pool, chat_id: int):
     """End a chat by chat connection ID. Returns (success: bool, user1_id, user2_id)."""
-    async with pool.acquire() as conn:
-        chat = await conn.fetchrow("""
-            SELECT user1_id, user2_id FROM chat_connections WHERE id = $1
-        """, chat_id)
+    chat = await pool.fetchrow("""
+        DELETE FROM chat_connections WHERE id = $1
+        RETURNING user1_id, user2_id
+    """, chat_id)
 
-        if chat:
-            await conn.execute("DELETE FROM chat_connections WHERE id = $1", chat_id)
-            return True, chat["user1_id"], chat["user2_id"]
-        return False, None, None
+    if chat:
+        _partner_cache.pop(chat["user1_id"])
+        _partner_cache.pop(chat["user2_id"])
+        invalidate_bot_statistics()
+        return True, chat["user1_id"], chat["user2_id"]
+    return False, None, None
 
 
 async def log_admin_action(pool, admin_id: int, action: str, details: str = None):
-    """Log an admin action to the database."""
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO admin_logs (admin_id, action, details)
-            VALUES ($1, $2, $3)
-        """, admin_id, action, details)
+    """
+    Log an admin action to the admin_logs table.
+    The row is queued and written in a batch by the admin log writer.
+    """
+    row = (admin_id, action, details)
+    if _admin_log_writer is not None:
+        _admin_log_writer.put(row)
+    else:
+        await log_admin_actions(pool, [row])
+
+
+async def log_admin_actions(pool, rows: list[tuple]):
+    """
+    Log many admin actions in one call (e.g. a bulk ban/unban sweep).
+    rows is a list of (admin_id, action, details) tuples.
+    """
+    await pool.executemany("""
+        INSERT INTO admin_logs (admin_id, action, details)
+        VALUES ($1, $2, $3)
+    """, rows)
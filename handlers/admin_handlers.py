@@ -7,21 +7,25 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from collections import OrderedDict
+from datetime import datetime
 import asyncio
+import hashlib
 import logging
 
-from config import TIMEZONE
 from db import (
     is_user_admin,
     get_all_active_chats,
     get_chat_message_count,
     get_all_banned_users,
-    get_banned_users_count,
+    get_bot_statistics,
+    get_recent_users,
+    count_broadcast_users,
+    iter_broadcast_user_ids,
     admin_end_chat_by_id,
     log_admin_action,
+    log_admin_actions,
     end_chat,
     get_user_full_info,
     get_user_payment_history,
@@ -29,9 +33,13 @@ from db import (
     PAYMENT_STATUSES,
     PAYMENT_METHOD_NAMES,
     log_message,
-    get_or_create_user
+    get_or_create_user,
+    set_user_ban,
+    set_user_bans,
+    remove_user_ban
 )
 from states import BanState, BroadcastState, SearchUserState, AdminMessageState
+from utils import RateLimiter
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -39,28 +47,123 @@ logger = logging.getLogger(__name__)
 # Create router for admin handlers
 admin_router = Router()
 
+# Telegram allows roughly 30 messages per second per bot for broadcasts
+BROADCAST_RATE = 30
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_CONCURRENCY = 30
+_broadcast_limiter = RateLimiter(BROADCAST_RATE, 1.0)
+
+# "Permanent" ban end (naive, like muted_until); bans are lifted explicitly via unban
+_FAR_FUTURE = datetime(2125, 1, 1)
+
+# Compact created_at encoding for recent-users pagination cursors (fits in callback_data)
+RECENT_USERS_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+# Last content written by safe_edit_text per (chat_id, message_id): (signature, edit_date).
+# A refresh that would produce the same content skips the Telegram call entirely.
+EDIT_SIGNATURES_MAX = 1024
+_edit_signatures = OrderedDict()
+
+
+def _edit_signature(text: str, reply_markup, parse_mode) -> bytes:
+    markup = reply_markup.model_dump_json() if reply_markup is not None else ""
+    payload = f"{parse_mode}\0{text}\0{markup}".encode()
+    return hashlib.blake2b(payload, digest_size=8).digest()
+
+
+async def safe_edit_text(callback: CallbackQuery, text: str, reply_markup=None, parse_mode=None) -> bool:
+    """
+    Safely edit message text, skipping the edit when the content is unchanged.
+    Returns True if the message was edited, False if it already showed this content.
+    Does not answer the callback; callers do that.
+    """
+    message = callback.message
+    key = (message.chat.id, message.message_id)
+    signature = _edit_signature(text, reply_markup, parse_mode)
+
+    # Only trust the cached signature if nothing else has edited the message since
+    cached = _edit_signatures.get(key)
+    if cached is not None and cached == (signature, message.edit_date):
+        return False
 
-async def safe_edit_text(callback: CallbackQuery, text: str, reply_markup=None, parse_mode=None):
-    """Safely edit message text, handling TelegramBadRequest for unchanged content."""
     try:
-        await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        result = await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
     except TelegramBadRequest as e:
-        if "message is not modified" in str(e).lower():
-            # Message content hasn't changed, just answer silently
-            await callback.answer()
-        else:
+        if "message is not modified" not in str(e).lower():
             raise
+        edited, edit_date = False, message.edit_date
+    else:
+        edited = True
+        edit_date = result.edit_date if isinstance(result, Message) else None
+
+    if edit_date is not None:
+        _edit_signatures[key] = (signature, edit_date)
+        _edit_signatures.move_to_end(key)
+        while len(_edit_signatures) > EDIT_SIGNATURES_MAX:
+            _edit_signatures.popitem(last=False)
+    return edited
+
+
+# Static keyboards, built once at import instead of on every callback
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📢 Broadcast", callback_data="admin:broadcast_options")],
+    [InlineKeyboardButton(text="📊 Statistika", callback_data="admin:stats")],
+    [InlineKeyboardButton(text="👥 Foydalanuvchilar", callback_data="admin:users")],
+    [InlineKeyboardButton(text="💬 Live chat monitoring", callback_data="admin:live_chats")],
+    [InlineKeyboardButton(text="⚙️ Settings", callback_data="admin:settings")],
+])
+
+USERS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔍 Foydalanuvchini qidirish", callback_data="admin:search")],
+    [InlineKeyboardButton(text="🆕 So'nggi 10 user", callback_data="admin:recent_users:1")],
+    [InlineKeyboardButton(text="⛔ Bloklanganlar", callback_data="admin:banned_list")],
+    [InlineKeyboardButton(text="⛔ Bloklash", callback_data="admin:punish")],
+    [InlineKeyboardButton(text="🔓 Blokdan chiqarish", callback_data="admin:unban")],
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")],
+])
+
+
+def _cancel_keyboard(callback_data: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data=callback_data)]
+    ])
+
+
+CANCEL_SEARCH_KB = _cancel_keyboard("admin:cancel_search")
+CANCEL_MESSAGE_KB = _cancel_keyboard("admin:cancel_message")
+CANCEL_BAN_KB = _cancel_keyboard("admin:cancel_ban")
+CANCEL_UNBAN_KB = _cancel_keyboard("admin:cancel_unban")
+CANCEL_BROADCAST_KB = _cancel_keyboard("admin:cancel_broadcast")
+
+BACK_TO_PANEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
+])
+
+BACK_TO_USERS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:users")]
+])
+
+BROADCAST_OPTIONS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="👥 Barcha foydalanuvchilar", callback_data="admin:broadcast:all")],
+    [InlineKeyboardButton(text="❌ Premium bo'lmaganlar", callback_data="admin:broadcast:non_premium")],
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:main")]
+])
+
+LIVE_CHATS_EMPTY_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Yangilash", callback_data="admin:live_chats")],
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
+])
+
+SETTINGS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Yangilash", callback_data="admin:settings")],
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
+])
 
 
 def get_main_menu_keyboard():
     """Get main admin panel menu keyboard."""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Broadcast", callback_data="admin:broadcast_options")],
-        [InlineKeyboardButton(text="📊 Statistika", callback_data="admin:stats")],
-        [InlineKeyboardButton(text="👥 Foydalanuvchilar", callback_data="admin:users")],
-        [InlineKeyboardButton(text="💬 Live chat monitoring", callback_data="admin:live_chats")],
-        [InlineKeyboardButton(text="⚙️ Settings", callback_data="admin:settings")],
-    ])
+    return MAIN_MENU_KB
 
 
 @admin_router.callback_query(F.data == "admin:main")
@@ -75,7 +178,7 @@ async def admin_panel_main(callback: CallbackQuery, bot: Bot, dispatcher):
     
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard(),
+        reply_markup=MAIN_MENU_KB,
         parse_mode=ParseMode.HTML
     )
     await callback.answer()
@@ -94,7 +197,7 @@ async def admin_panel_entry(message: Message, bot: Bot, dispatcher):
 
     await message.answer(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
 
 
@@ -103,7 +206,7 @@ async def back_to_main_menu(callback: CallbackQuery):
     """Return to main admin panel menu."""
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer()
 
@@ -114,41 +217,24 @@ async def back_to_main_menu(callback: CallbackQuery):
 async def show_statistics(callback: CallbackQuery, bot: Bot, dispatcher):
     """Display bot statistics with all metrics."""
     pool = dispatcher["db"]
-    user_id = callback.from_user.id
 
-    tashkent_now = datetime.now(ZoneInfo(TIMEZONE))
-    today_start = tashkent_now.replace(hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
-    month_start = tashkent_now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
-
-    async with pool.acquire() as conn:
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        today_users = await conn.fetchval(
-            "SELECT COUNT(*) FROM users WHERE created_at >= $1", today_start
-        )
-        month_users = await conn.fetchval(
-            "SELECT COUNT(*) FROM users WHERE created_at >= $1", month_start
-        )
-        active_chats_count = await conn.fetchval("SELECT COUNT(*) FROM chat_connections")
-        banned_count = await get_banned_users_count(pool)
-        queue_count = await conn.fetchval("SELECT COUNT(*) FROM chat_queue")
+    # Ack the click while the counts are fetched instead of after
+    _, stats = await asyncio.gather(callback.answer(), get_bot_statistics(pool))
 
     text = (
         "<b>📊 Statistika</b>\n\n"
-        f"👥 Umumiy foydalanuvchilar: <b>{total_users}</b>\n"
-        f"📅 Oylik qo'shilganlar: <b>{month_users}</b>\n"
-        f"📆 Kunlik qo'shilganlar: <b>{today_users}</b>\n"
-        f"💬 Faol chatlar: <b>{active_chats_count}</b>\n"
-        f"⛔ Bloklanganlar: <b>{banned_count}</b>\n"
-        f"⏳ Navbatda: <b>{queue_count}</b>"
+        f"👥 Umumiy foydalanuvchilar: <b>{stats['total_users']}</b>\n"
+        f"📅 Oylik qo'shilganlar: <b>{stats['month_users']}</b>\n"
+        f"📆 Kunlik qo'shilganlar: <b>{stats['today_users']}</b>\n"
+        f"💬 Faol chatlar: <b>{stats['active_chats']}</b>\n"
+        f"⛔ Bloklanganlar: <b>{stats['banned']}</b>\n"
+        f"⏳ Navbatda: <b>{stats['queue']}</b>"
     )
 
     await callback.message.edit_text(
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
-        ])
+        reply_markup=BACK_TO_PANEL_KB
     )
-    await callback.answer()
 
 
 # ==================== USERS SECTION ====================
@@ -156,18 +242,9 @@ async def show_statistics(callback: CallbackQuery, bot: Bot, dispatcher):
 @admin_router.callback_query(F.data == "admin:users")
 async def open_users_menu(callback: CallbackQuery):
     """Open users management menu."""
-    users_menu = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Foydalanuvchini qidirish", callback_data="admin:search")],
-        [InlineKeyboardButton(text="🆕 So'nggi 10 user", callback_data="admin:recent_users:1")],
-        [InlineKeyboardButton(text="⛔ Bloklanganlar", callback_data="admin:banned_list")],
-        [InlineKeyboardButton(text="⛔ Bloklash", callback_data="admin:punish")],
-        [InlineKeyboardButton(text="🔓 Blokdan chiqarish", callback_data="admin:unban")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")],
-    ])
-
     await callback.message.edit_text(
         "<b>👥 Foydalanuvchilar bo'limi:</b>\nKerakli funksiyani tanlang:",
-        reply_markup=users_menu
+        reply_markup=USERS_MENU_KB
     )
     await callback.answer()
 
@@ -182,19 +259,17 @@ async def show_banned_users(callback: CallbackQuery, bot: Bot, dispatcher):
         await callback.message.edit_text(
             "<b>⛔ Bloklangan foydalanuvchilar</b>\n\n"
             "😕 Hozircha bloklangan foydalanuvchilar yo'q.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:users")]
-            ])
+            reply_markup=BACK_TO_USERS_KB
         )
         await callback.answer()
         return
 
-    text = "<b>⛔ Bloklangan foydalanuvchilar:</b>\n\n"
+    parts = ["<b>⛔ Bloklangan foydalanuvchilar:</b>\n\n"]
     buttons = []
 
     for banned in banned_users:
         user_name = banned['name'] or "Noma'lum"
-        text += (
+        parts.append(
             f"👤 <a href='tg://user?id={banned['user_id']}'>{user_name}</a>\n"
             f"🆔 ID: <code>{banned['user_id']}</code>\n\n"
         )
@@ -209,7 +284,7 @@ async def show_banned_users(callback: CallbackQuery, bot: Bot, dispatcher):
     buttons.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:users")])
 
     await callback.message.edit_text(
-        text,
+        "".join(parts),
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
     )
@@ -223,10 +298,7 @@ async def unban_user_from_list(callback: CallbackQuery, bot: Bot, dispatcher):
     user_id = int(callback.data.split(":")[-1])
     admin_id = callback.from_user.id
 
-    async with pool.acquire() as conn:
-        result = await conn.execute("DELETE FROM muted_users WHERE user_id = $1", user_id)
-
-    if result == "DELETE 1":
+    if await remove_user_ban(pool, user_id):
         await log_admin_action(pool, admin_id, "unban_user", f"User ID: {user_id}")
         await callback.answer(f"✅ Foydalanuvchi blokdan chiqarildi!", show_alert=True)
         # Refresh the banned list
@@ -240,9 +312,7 @@ async def ask_user_id(callback: CallbackQuery, state: FSMContext):
     """Start user search flow."""
     await callback.message.edit_text(
         "🔍 Qidirish uchun foydalanuvchi ID sini yuboring:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin:cancel_search")]
-        ])
+        reply_markup=CANCEL_SEARCH_KB
     )
     await state.set_state(SearchUserState.waiting_for_user_id)
     await callback.answer()
@@ -254,11 +324,95 @@ async def cancel_search(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer("❌ Qidiruv bekor qilindi.")
 
 
+USER_INFO_SEPARATOR = "━" * 20 + "\n"
+
+
+def _render_user_info(user_info, back_callback: str) -> tuple[str, InlineKeyboardMarkup]:
+    """Build the admin user card (text and action keyboard) from get_user_full_info."""
+    user_id = user_info['user_id']
+    is_banned = user_info['is_banned']
+    in_chat = user_info['partner_id'] is not None
+
+    parts = [
+        "👤 <b>Foydalanuvchi ma'lumotlari</b>\n\n",
+        USER_INFO_SEPARATOR,
+        f"🆔 <b>ID:</b> <code>{user_id}</code>\n",
+        f"📛 <b>Ism:</b> {user_info['name']}\n",
+    ]
+    if user_info['username']:
+        parts.append(f"👤 <b>Username:</b> @{user_info['username']}\n")
+    parts += [
+        f"🗓 <b>Ro'yxatdan o'tgan:</b> {user_info['created_at']:%Y-%m-%d %H:%M}\n",
+        f"🛡 <b>Admin:</b> {'✅' if user_info['is_admin'] else '❌'}\n",
+        f"👑 <b>Superuser:</b> {'✅' if user_info['is_superuser'] else '❌'}\n",
+        f"🔇 <b>Blok:</b> {'✅' if is_banned else '❌'}\n",
+        f"💬 <b>Chatda:</b> {'✅' if in_chat else '❌'}\n\n",
+
+        USER_INFO_SEPARATOR,
+        "<b>💰 Balans ma'lumotlari</b>\n",
+        USER_INFO_SEPARATOR,
+        f"💵 <b>Joriy balans:</b> {user_info['balance']:,.2f} so'm\n",
+        f"📊 <b>Jami yuklangan:</b> {user_info['total_deposited']:,.2f} so'm\n\n",
+
+        USER_INFO_SEPARATOR,
+        "<b>💎 Premium ma'lumotlari</b>\n",
+        USER_INFO_SEPARATOR,
+        f"💎 <b>Premium:</b> {'✅ Faol' if user_info['is_premium'] else '❌ Faol emas'}\n",
+    ]
+
+    sub = user_info['subscription']
+    if sub:
+        plan_name = VALID_PLANS.get(sub['plan'], sub['plan'])
+        parts += [
+            f"📦 <b>Plan:</b> {plan_name}\n",
+            f"📅 <b>Boshlanish:</b> {sub['start_date']:%Y-%m-%d %H:%M}\n",
+            f"📅 <b>Tugash:</b> {sub['end_date']:%Y-%m-%d %H:%M}\n",
+            f"🔄 <b>Faol:</b> {'✅' if sub['is_active'] else '❌'}\n",
+        ]
+    else:
+        parts.append("📦 <b>Plan:</b> Yo'q\n")
+
+    parts += ["\n", USER_INFO_SEPARATOR, "<b>🎁 Referral ma'lumotlari</b>\n", USER_INFO_SEPARATOR]
+    if user_info['referral_code']:
+        parts.append(f"🔑 <b>Referral kodi:</b> <code>{user_info['referral_code']}</code>\n")
+    else:
+        parts.append("🔑 <b>Referral kodi:</b> Yo'q\n")
+    parts += [
+        f"👥 <b>Taklif qilingan:</b> {user_info['referral_count']} ta\n",
+        f"💰 <b>Referral daromadi:</b> {user_info['referral_earnings']:,.2f} so'm\n",
+    ]
+    if user_info['referrer_name']:
+        parts.append(f"👤 <b>Taklif qilgan:</b> {user_info['referrer_name']} (ID: {user_info.get('referral_by', 'N/A')})\n")
+    else:
+        parts.append("👤 <b>Taklif qilgan:</b> Yo'q\n")
+
+    parts += ["\n", USER_INFO_SEPARATOR, "<b>📊 Faollik</b>\n", USER_INFO_SEPARATOR]
+    if user_info['last_activity']:
+        parts.append(f"🕐 <b>Oxirgi faollik:</b> {user_info['last_activity']:%Y-%m-%d %H:%M}\n")
+    else:
+        parts.append("🕐 <b>Oxirgi faollik:</b> Ma'lumot yo'q\n")
+
+    if is_banned:
+        buttons = [[InlineKeyboardButton(text="🔓 Blokdan chiqarish", callback_data=f"admin:unban_user:{user_id}")]]
+    else:
+        buttons = [[InlineKeyboardButton(text="⛔ Bloklash", callback_data=f"admin:ban_user:{user_id}")]]
+    if in_chat:
+        buttons.append([InlineKeyboardButton(text="💬 Chatni tugatish", callback_data=f"admin:end_user_chat:{user_id}")])
+    buttons += [
+        [InlineKeyboardButton(text="👤 Profilni ko'rish", url=f"tg://user?id={user_id}")],
+        [InlineKeyboardButton(text="💳 To'lovlar tarixi", callback_data=f"admin:payment_history:{user_id}")],
+        [InlineKeyboardButton(text="📨 Anonim xabar yuborish", callback_data=f"admin:send_message:{user_id}")],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=back_callback)],
+    ]
+
+    return "".join(parts), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 @admin_router.message(SearchUserState.waiting_for_user_id)
 async def show_user_info(message: Message, state: FSMContext, bot: Bot, dispatcher):
     """Display user information by ID."""
@@ -277,122 +431,8 @@ async def show_user_info(message: Message, state: FSMContext, bot: Bot, dispatch
         await message.answer("😕 Bunday foydalanuvchi topilmadi.")
         return
 
-    async with pool.acquire() as conn:
-        banned_row = await conn.fetchrow("SELECT user_id FROM muted_users WHERE user_id = $1", user_id)
-        # Check if in active chat
-        chat_row = await conn.fetchrow("""
-            SELECT user1_id, user2_id FROM chat_connections 
-            WHERE user1_id = $1 OR user2_id = $1
-        """, user_id)
-
-    is_banned = bool(banned_row)
-    in_chat = bool(chat_row)
-    partner_id = None
-    if chat_row:
-        partner_id = chat_row["user2_id"] if chat_row["user1_id"] == user_id else chat_row["user1_id"]
-
-    # Build comprehensive user info text
-    text = f"👤 <b>Foydalanuvchi ma'lumotlari</b>\n\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"🆔 <b>ID:</b> <code>{user_info['user_id']}</code>\n"
-    text += f"📛 <b>Ism:</b> {user_info['name']}\n"
-    if user_info['username']:
-        text += f"👤 <b>Username:</b> @{user_info['username']}\n"
-    text += f"🗓 <b>Ro'yxatdan o'tgan:</b> {user_info['created_at']:%Y-%m-%d %H:%M}\n"
-    text += f"🛡 <b>Admin:</b> {'✅' if user_info['is_admin'] else '❌'}\n"
-    text += f"👑 <b>Superuser:</b> {'✅' if user_info['is_superuser'] else '❌'}\n"
-    text += f"🔇 <b>Blok:</b> {'✅' if is_banned else '❌'}\n"
-    text += f"💬 <b>Chatda:</b> {'✅' if in_chat else '❌'}\n\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>💰 Balans ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"💵 <b>Joriy balans:</b> {user_info['balance']:,.2f} so'm\n"
-    text += f"📊 <b>Jami yuklangan:</b> {user_info['total_deposited']:,.2f} so'm\n\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>💎 Premium ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"💎 <b>Premium:</b> {'✅ Faol' if user_info['is_premium'] else '❌ Faol emas'}\n"
-    
-    if user_info['subscription']:
-        sub = user_info['subscription']
-        plan_name = VALID_PLANS.get(sub['plan'], sub['plan'])
-        text += f"📦 <b>Plan:</b> {plan_name}\n"
-        text += f"📅 <b>Boshlanish:</b> {sub['start_date']:%Y-%m-%d %H:%M}\n"
-        text += f"📅 <b>Tugash:</b> {sub['end_date']:%Y-%m-%d %H:%M}\n"
-        text += f"🔄 <b>Faol:</b> {'✅' if sub['is_active'] else '❌'}\n"
-    else:
-        text += f"📦 <b>Plan:</b> Yo'q\n"
-    text += f"\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>🎁 Referral ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    if user_info['referral_code']:
-        text += f"🔑 <b>Referral kodi:</b> <code>{user_info['referral_code']}</code>\n"
-    else:
-        text += f"🔑 <b>Referral kodi:</b> Yo'q\n"
-    text += f"👥 <b>Taklif qilingan:</b> {user_info['referral_count']} ta\n"
-    text += f"💰 <b>Referral daromadi:</b> {user_info['referral_earnings']:,.2f} so'm\n"
-    if user_info['referrer_name']:
-        text += f"👤 <b>Taklif qilgan:</b> {user_info['referrer_name']} (ID: {user_info.get('referral_by', 'N/A')})\n"
-    else:
-        text += f"👤 <b>Taklif qilgan:</b> Yo'q\n"
-    text += f"\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>📊 Faollik</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    if user_info['last_activity']:
-        text += f"🕐 <b>Oxirgi faollik:</b> {user_info['last_activity']:%Y-%m-%d %H:%M}\n"
-    else:
-        text += f"🕐 <b>Oxirgi faollik:</b> Ma'lumot yo'q\n"
-
-    buttons = []
-    if is_banned:
-        buttons.append([InlineKeyboardButton(
-            text="🔓 Blokdan chiqarish",
-            callback_data=f"admin:unban_user:{user_id}"
-        )])
-    else:
-        buttons.append([InlineKeyboardButton(
-            text="⛔ Bloklash",
-            callback_data=f"admin:ban_user:{user_id}"
-        )])
-
-    if in_chat and partner_id:
-        buttons.append([InlineKeyboardButton(
-            text="💬 Chatni tugatish",
-            callback_data=f"admin:end_user_chat:{user_id}"
-        )])
-    
-    # Add profile button
-    user_profile_link = f"tg://user?id={user_id}"
-    buttons.append([InlineKeyboardButton(
-        text="👤 Profilni ko'rish",
-        url=user_profile_link
-    )])
-    
-    # Add payment history button
-    buttons.append([InlineKeyboardButton(
-        text="💳 To'lovlar tarixi",
-        callback_data=f"admin:payment_history:{user_id}"
-    )])
-    
-    # Add anonymous message button
-    buttons.append([InlineKeyboardButton(
-        text="📨 Anonim xabar yuborish",
-        callback_data=f"admin:send_message:{user_id}"
-    )])
-
-    buttons.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:users")])
-
-    await message.answer(
-        text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
-    )
+    text, keyboard = _render_user_info(user_info, back_callback="admin:users")
+    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
 
 
 @admin_router.callback_query(F.data.startswith("admin:ban_user:"))
@@ -402,16 +442,7 @@ async def ban_user_from_info(callback: CallbackQuery, bot: Bot, dispatcher):
     user_id = int(callback.data.split(":")[-1])
     admin_id = callback.from_user.id
     
-    # Set muted_until to a far future date (e.g., 100 years from now)
-    muted_until = (datetime.now(ZoneInfo(TIMEZONE)) + timedelta(days=36500)).replace(tzinfo=None)
-    
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO muted_users (user_id, muted_until, reason)
-            VALUES ($1, $2, NULL)
-            ON CONFLICT (user_id) DO UPDATE
-            SET muted_until = $2, reason = NULL, created_at = CURRENT_TIMESTAMP
-        """, user_id, muted_until)
+    await set_user_ban(pool, user_id, _FAR_FUTURE)
 
     await log_admin_action(pool, admin_id, "ban_user", f"User ID: {user_id}")
     await callback.answer(f"✅ Foydalanuvchi bloklandi!", show_alert=True)
@@ -431,11 +462,12 @@ async def end_user_chat_from_info(callback: CallbackQuery, bot: Bot, dispatcher)
 
     if ended and partner_id:
         await log_admin_action(pool, admin_id, "end_chat", f"Ended chat between {user_id} and {partner_id}")
-        try:
-            await bot.send_message(user_id, "✅ Chat admin tomonidan tugatildi.")
-            await bot.send_message(partner_id, "✅ Chat admin tomonidan tugatildi.")
-        except:
-            pass
+        # Notify both sides concurrently; either may have blocked the bot
+        await asyncio.gather(
+            bot.send_message(user_id, "✅ Chat admin tomonidan tugatildi."),
+            bot.send_message(partner_id, "✅ Chat admin tomonidan tugatildi."),
+            return_exceptions=True
+        )
         await callback.answer("✅ Chat tugatildi!", show_alert=True)
         await callback.message.delete()
     else:
@@ -446,32 +478,50 @@ async def end_user_chat_from_info(callback: CallbackQuery, bot: Bot, dispatcher)
 async def show_recent_users(callback: CallbackQuery, bot: Bot, dispatcher):
     """Display recent users with pagination."""
     pool = dispatcher["db"]
-    page = int(callback.data.split(":")[-1])
     users_per_page = 10
-    offset = (page - 1) * users_per_page
-
-    async with pool.acquire() as conn:
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        users = await conn.fetch(
-            "SELECT user_id, name, created_at FROM users ORDER BY created_at DESC LIMIT $1 OFFSET $2",
-            users_per_page, offset
-        )
 
-    total_pages = (total_users + users_per_page - 1) // users_per_page
+    # admin:recent_users:1 opens the first page; pagination buttons carry a
+    # keyset cursor instead: admin:recent_users:<next|prev>:<created_at>:<user_id>
+    parts = callback.data.split(":")
+    cursor = None
+    backwards = False
+    if len(parts) == 5:
+        backwards = parts[2] == "prev"
+        cursor = (datetime.strptime(parts[3], RECENT_USERS_CURSOR_FORMAT), int(parts[4]))
+
+    users, has_more = await get_recent_users(pool, users_per_page, cursor, backwards)
+
+    if cursor is None:
+        has_prev, has_next = False, has_more
+    elif backwards:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = True, has_more
 
-    text = "<b>🆕 So'nggi foydalanuvchilar:</b>\n\n"
+    parts = ["<b>🆕 So'nggi foydalanuvchilar:</b>\n\n"]
     if not users:
-        text += "😕 Foydalanuvchilar topilmadi."
+        parts.append("😕 Foydalanuvchilar topilmadi.")
     else:
-        for user in users:
-            text += f"🆔 <code>{user['user_id']}</code> | {user['name']} | {user['created_at']:%Y-%m-%d %H:%M}\n"
+        parts.extend(
+            f"🆔 <code>{user['user_id']}</code> | {user['name']} | {user['created_at']:%Y-%m-%d %H:%M}\n"
+            for user in users
+        )
+    text = "".join(parts)
 
     # Pagination buttons
     buttons = []
-    if page > 1:
-        buttons.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"admin:recent_users:{page - 1}"))
-    if page < total_pages:
-        buttons.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"admin:recent_users:{page + 1}"))
+    if users and has_prev:
+        first = users[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Oldingi",
+            callback_data=f"admin:recent_users:prev:{first['created_at']:{RECENT_USERS_CURSOR_FORMAT}}:{first['user_id']}"
+        ))
+    if users and has_next:
+        last = users[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Keyingi ➡️",
+            callback_data=f"admin:recent_users:next:{last['created_at']:{RECENT_USERS_CURSOR_FORMAT}}:{last['user_id']}"
+        ))
 
     # User selection buttons
     user_buttons = [
@@ -502,121 +552,8 @@ async def select_user(callback: CallbackQuery, bot: Bot, dispatcher):
         await callback.answer()
         return
 
-    async with pool.acquire() as conn:
-        banned_row = await conn.fetchrow("SELECT user_id FROM muted_users WHERE user_id = $1", user_id)
-        chat_row = await conn.fetchrow("""
-            SELECT user1_id, user2_id FROM chat_connections 
-            WHERE user1_id = $1 OR user2_id = $1
-        """, user_id)
-
-    is_banned = bool(banned_row)
-    in_chat = bool(chat_row)
-    partner_id = None
-    if chat_row:
-        partner_id = chat_row["user2_id"] if chat_row["user1_id"] == user_id else chat_row["user1_id"]
-
-    # Build comprehensive user info text
-    text = f"👤 <b>Foydalanuvchi ma'lumotlari</b>\n\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"🆔 <b>ID:</b> <code>{user_info['user_id']}</code>\n"
-    text += f"📛 <b>Ism:</b> {user_info['name']}\n"
-    if user_info['username']:
-        text += f"👤 <b>Username:</b> @{user_info['username']}\n"
-    text += f"🗓 <b>Ro'yxatdan o'tgan:</b> {user_info['created_at']:%Y-%m-%d %H:%M}\n"
-    text += f"🛡 <b>Admin:</b> {'✅' if user_info['is_admin'] else '❌'}\n"
-    text += f"👑 <b>Superuser:</b> {'✅' if user_info['is_superuser'] else '❌'}\n"
-    text += f"🔇 <b>Blok:</b> {'✅' if is_banned else '❌'}\n"
-    text += f"💬 <b>Chatda:</b> {'✅' if in_chat else '❌'}\n\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>💰 Balans ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"💵 <b>Joriy balans:</b> {user_info['balance']:,.2f} so'm\n"
-    text += f"📊 <b>Jami yuklangan:</b> {user_info['total_deposited']:,.2f} so'm\n\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>💎 Premium ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"💎 <b>Premium:</b> {'✅ Faol' if user_info['is_premium'] else '❌ Faol emas'}\n"
-    
-    if user_info['subscription']:
-        sub = user_info['subscription']
-        plan_name = VALID_PLANS.get(sub['plan'], sub['plan'])
-        text += f"📦 <b>Plan:</b> {plan_name}\n"
-        text += f"📅 <b>Boshlanish:</b> {sub['start_date']:%Y-%m-%d %H:%M}\n"
-        text += f"📅 <b>Tugash:</b> {sub['end_date']:%Y-%m-%d %H:%M}\n"
-        text += f"🔄 <b>Faol:</b> {'✅' if sub['is_active'] else '❌'}\n"
-    else:
-        text += f"📦 <b>Plan:</b> Yo'q\n"
-    text += f"\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>🎁 Referral ma'lumotlari</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    if user_info['referral_code']:
-        text += f"🔑 <b>Referral kodi:</b> <code>{user_info['referral_code']}</code>\n"
-    else:
-        text += f"🔑 <b>Referral kodi:</b> Yo'q\n"
-    text += f"👥 <b>Taklif qilingan:</b> {user_info['referral_count']} ta\n"
-    text += f"💰 <b>Referral daromadi:</b> {user_info['referral_earnings']:,.2f} so'm\n"
-    if user_info['referrer_name']:
-        text += f"👤 <b>Taklif qilgan:</b> {user_info['referrer_name']} (ID: {user_info.get('referral_by', 'N/A')})\n"
-    else:
-        text += f"👤 <b>Taklif qilgan:</b> Yo'q\n"
-    text += f"\n"
-    
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"<b>📊 Faollik</b>\n"
-    text += f"━━━━━━━━━━━━━━━━━━━━\n"
-    if user_info['last_activity']:
-        text += f"🕐 <b>Oxirgi faollik:</b> {user_info['last_activity']:%Y-%m-%d %H:%M}\n"
-    else:
-        text += f"🕐 <b>Oxirgi faollik:</b> Ma'lumot yo'q\n"
-
-    buttons = []
-    if is_banned:
-        buttons.append([InlineKeyboardButton(
-            text="🔓 Blokdan chiqarish",
-            callback_data=f"admin:unban_user:{user_id}"
-        )])
-    else:
-        buttons.append([InlineKeyboardButton(
-            text="⛔ Bloklash",
-            callback_data=f"admin:ban_user:{user_id}"
-        )])
-
-    if in_chat and partner_id:
-        buttons.append([InlineKeyboardButton(
-            text="💬 Chatni tugatish",
-            callback_data=f"admin:end_user_chat:{user_id}"
-        )])
-    
-    # Add profile button
-    user_profile_link = f"tg://user?id={user_id}"
-    buttons.append([InlineKeyboardButton(
-        text="👤 Profilni ko'rish",
-        url=user_profile_link
-    )])
-    
-    # Add payment history button
-    buttons.append([InlineKeyboardButton(
-        text="💳 To'lovlar tarixi",
-        callback_data=f"admin:payment_history:{user_id}"
-    )])
-    
-    # Add anonymous message button
-    buttons.append([InlineKeyboardButton(
-        text="📨 Anonim xabar yuborish",
-        callback_data=f"admin:send_message:{user_id}"
-    )])
-
-    buttons.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:recent_users:1")])
-
-    await callback.message.edit_text(
-        text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
-    )
+    text, keyboard = _render_user_info(user_info, back_callback="admin:recent_users:1")
+    await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
     await callback.answer()
 
 
@@ -633,9 +570,7 @@ async def start_admin_message(callback: CallbackQuery, state: FSMContext):
         "<b>📨 Anonim xabar yuborish</b>\n\n"
         "Xabarni yuboring (matn, rasm, video, ovoz yoki hujjat):",
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin:cancel_message")]
-        ])
+        reply_markup=CANCEL_MESSAGE_KB
     )
     await callback.answer()
 
@@ -830,10 +765,9 @@ async def start_ban(callback: CallbackQuery, state: FSMContext):
     """Start ban user flow."""
     await state.set_state(BanState.waiting_for_user_id)
     await callback.message.edit_text(
-        "🆔 Foydalanuvchi ID raqamini yuboring:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin:cancel_ban")]
-        ])
+        "🆔 Foydalanuvchi ID raqamini yuboring:\n"
+        "<i>Bir nechta foydalanuvchini bloklash uchun har bir ID ni yangi qatorga yozing.</i>",
+        reply_markup=CANCEL_BAN_KB
     )
     await callback.answer()
 
@@ -844,30 +778,30 @@ async def cancel_ban(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer("❌ Bloklash bekor qilindi.")
 
 
 @admin_router.message(BanState.waiting_for_user_id)
 async def get_user_id(message: Message, state: FSMContext, bot: Bot, dispatcher):
-    """Get user ID for banning and ban immediately."""
+    """Get user ID(s) for banning and ban immediately (one ID per line for a bulk ban)."""
     try:
-        user_id = int(message.text.strip())
-        await state.clear()
-        admin_id = message.from_user.id
+        user_ids = list(dict.fromkeys(int(part) for part in message.text.split()))
+    except ValueError:
+        await message.answer("❌ Noto'g'ri ID. Qayta urinib ko'ring.")
+        return
+    if not user_ids:
+        await message.answer("❌ Noto'g'ri ID. Qayta urinib ko'ring.")
+        return
 
-        pool = dispatcher["db"]
-        # Set muted_until to a far future date (e.g., 100 years from now)
-        muted_until = (datetime.now(ZoneInfo(TIMEZONE)) + timedelta(days=36500)).replace(tzinfo=None)
-        
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO muted_users (user_id, muted_until, reason)
-                VALUES ($1, $2, NULL)
-                ON CONFLICT (user_id) DO UPDATE
-                SET muted_until = $2, reason = NULL, created_at = CURRENT_TIMESTAMP
-            """, user_id, muted_until)
+    await state.clear()
+    admin_id = message.from_user.id
+
+    pool = dispatcher["db"]
+    if len(user_ids) == 1:
+        user_id = user_ids[0]
+        await set_user_ban(pool, user_id, _FAR_FUTURE)
 
         await log_admin_action(pool, admin_id, "ban_user", f"User ID: {user_id}")
 
@@ -875,8 +809,21 @@ async def get_user_id(message: Message, state: FSMContext, bot: Bot, dispatcher)
             f"✅ <a href='tg://user?id={user_id}'>Foydalanuvchi</a> bloklandi.",
             parse_mode="HTML"
         )
-    except ValueError:
-        await message.answer("❌ Noto'g'ri ID. Qayta urinib ko'ring.")
+        return
+
+    # Bulk ban: one INSERT for all users and one batched audit-log write
+    banned_ids = await set_user_bans(pool, user_ids, _FAR_FUTURE)
+    if banned_ids:
+        await log_admin_actions(pool, [
+            (admin_id, "ban_user", f"User ID: {user_id}") for user_id in banned_ids
+        ])
+
+    text = f"✅ {len(banned_ids)} ta foydalanuvchi bloklandi."
+    missing_ids = set(user_ids).difference(banned_ids)
+    if missing_ids:
+        missing = ", ".join(f"<code>{user_id}</code>" for user_id in user_ids if user_id in missing_ids)
+        text += f"\n⚠️ Topilmadi: {missing}"
+    await message.answer(text, parse_mode="HTML")
 
 
 @admin_router.callback_query(F.data == "admin:unban")
@@ -885,9 +832,7 @@ async def ask_user_id_for_unban(callback: CallbackQuery, state: FSMContext):
     await state.set_state(BanState.waiting_for_unban_id)
     await callback.message.edit_text(
         "🔓 Blokdan chiqariladigan foydalanuvchi ID sini kiriting:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin:cancel_unban")]
-        ])
+        reply_markup=CANCEL_UNBAN_KB
     )
     await callback.answer()
 
@@ -898,7 +843,7 @@ async def cancel_unban(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer("❌ Blokdan chiqarish bekor qilindi.")
 
@@ -906,15 +851,17 @@ async def cancel_unban(callback: CallbackQuery, state: FSMContext):
 @admin_router.message(BanState.waiting_for_unban_id)
 async def unban_user(message: Message, state: FSMContext, bot: Bot, dispatcher):
     """Remove user from ban list."""
-    user_id = message.text.strip()
+    try:
+        user_id = int(message.text.strip())
+    except ValueError:
+        await message.answer("❌ Noto'g'ri ID. Qayta urinib ko'ring.")
+        return
+
     await state.clear()
     admin_id = message.from_user.id
 
     pool = dispatcher["db"]
-    async with pool.acquire() as conn:
-        result = await conn.execute("DELETE FROM muted_users WHERE user_id = $1", int(user_id))
-
-    if result == "DELETE 1":
+    if await remove_user_ban(pool, user_id):
         await log_admin_action(pool, admin_id, "unban_user", f"User ID: {user_id}")
         await message.answer(
             f"✅ <a href='tg://user?id={user_id}'>Foydalanuvchi</a> blokdan chiqarildi.",
@@ -933,11 +880,7 @@ async def show_broadcast_options(callback: CallbackQuery):
         "<b>📢 Broadcast</b>\n\n"
         "Kimlarga xabar yubormoqchisiz?",
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👥 Barcha foydalanuvchilar", callback_data="admin:broadcast:all")],
-            [InlineKeyboardButton(text="❌ Premium bo'lmaganlar", callback_data="admin:broadcast:non_premium")],
-            [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:main")]
-        ])
+        reply_markup=BROADCAST_OPTIONS_KB
     )
     await callback.answer()
 
@@ -958,9 +901,7 @@ async def start_broadcast(callback: CallbackQuery, state: FSMContext):
         "Yubormoqchi bo'lgan xabaringizni yozing:\n"
         "Matn yoki rasm/video bilan matn ham bo'lishi mumkin.",
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin:cancel_broadcast")]
-        ])
+        reply_markup=CANCEL_BROADCAST_KB
     )
     await callback.answer()
 
@@ -971,11 +912,24 @@ async def cancel_broadcast(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(
         "<b>👨‍💻 Admin panelga xush kelibsiz!</b>\nQuyidagilardan birini tanlang:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer("❌ Broadcast bekor qilindi.")
 
 
+async def _broadcast_copy(bot: Bot, chat_id: int, from_chat_id: int, message_id: int):
+    """Copy a broadcast message to one user, waiting out Telegram flood-control replies."""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await _broadcast_limiter.acquire()
+        try:
+            return await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+        except TelegramRetryAfter as e:
+            if attempt == BROADCAST_MAX_ATTEMPTS - 1:
+                raise
+            # Back off every sender, not just this one: the limit is per bot
+            _broadcast_limiter.pause(e.retry_after)
+
+
 @admin_router.message(BroadcastState.waiting_for_message)
 async def process_broadcast(message: Message, state: FSMContext, bot: Bot, dispatcher):
     """Process and send broadcast message to selected users."""
@@ -998,45 +952,43 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot, dispa
 
     success = 0
     fail = 0
-    batch_size = 30
-    delay_between_batches = 1.0
+    queued = 0
 
-    # Get users based on broadcast type
-    async with pool.acquire() as conn:
-        if broadcast_type == "non_premium":
-            users = await conn.fetch("SELECT user_id FROM users WHERE is_premium = FALSE")
-        else:
-            users = await conn.fetch("SELECT user_id FROM users")
-
-    total_users = len(users)
-    for i in range(0, total_users, batch_size):
-        batch = users[i:i + batch_size]
-        tasks = []
-
-        for user in batch:
-            tasks.append(bot.copy_message(
-                chat_id=user['user_id'],
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            ))
-
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for result in results:
-            if isinstance(result, Exception):
-                logger.error(f"Failed to send message to user: {result}")
-                fail += 1
-            else:
-                success += 1
+    # At most BROADCAST_CONCURRENCY sends in flight; a slow recipient only holds its own
+    # slot instead of stalling a whole batch. Pace is set by the rate limiter.
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    pending = set()
 
-        if (i + batch_size) % 100 == 0 or i + batch_size >= total_users:
+    async def send_one(recipient_id: int):
+        nonlocal success, fail
+        try:
+            await _broadcast_copy(bot, recipient_id, message.chat.id, message.message_id)
+            success += 1
+        except Exception as e:
+            logger.error(f"Failed to send message to user: {e}")
+            fail += 1
+        finally:
+            semaphore.release()
+
+    # Recipients are streamed from the database one batch at a time
+    non_premium_only = broadcast_type == "non_premium"
+    total_users = await count_broadcast_users(pool, non_premium_only)
+
+    async for batch in iter_broadcast_user_ids(pool, non_premium_only):
+        for recipient_id in batch:
+            await semaphore.acquire()
+            task = asyncio.create_task(send_one(recipient_id))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        queued += len(batch)
+        if queued < total_users:
             await message.answer(
-                f"<i>📬 Yuborilmoqda: {min(i + batch_size, total_users)} / {total_users} foydalanuvchi...</i>",
+                f"<i>📬 Yuborilmoqda: {success + fail} / {total_users} foydalanuvchi...</i>",
                 parse_mode=ParseMode.HTML
             )
 
-        if i + batch_size < total_users:
-            await asyncio.sleep(delay_between_batches)
+    await asyncio.gather(*pending)
 
     target_description = "barcha foydalanuvchilar" if broadcast_type == "all" else "premium bo'lmagan foydalanuvchilar"
     
@@ -1063,21 +1015,22 @@ async def show_live_chats(callback: CallbackQuery, bot: Bot, dispatcher):
     active_chats = await get_all_active_chats(pool)
 
     if not active_chats:
-        await safe_edit_text(
-            callback,
-            "<b>💬 Live chat monitoring</b>\n\n"
-            "😕 Hozircha faol chatlar yo'q.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔄 Yangilash", callback_data="admin:live_chats")],
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
-            ]),
-            parse_mode=ParseMode.HTML
+        await asyncio.gather(
+            safe_edit_text(
+                callback,
+                "<b>💬 Live chat monitoring</b>\n\n"
+                "😕 Hozircha faol chatlar yo'q.",
+                reply_markup=LIVE_CHATS_EMPTY_KB,
+                parse_mode=ParseMode.HTML
+            ),
+            callback.answer()
         )
-        await callback.answer()
         return
 
-    text = f"<b>💬 Live chat monitoring</b>\n\n"
-    text += f"📊 Faol chatlar soni: <b>{len(active_chats)}</b>\n\n"
+    parts = [
+        "<b>💬 Live chat monitoring</b>\n\n",
+        f"📊 Faol chatlar soni: <b>{len(active_chats)}</b>\n\n",
+    ]
 
     buttons = []
     for chat in active_chats:
@@ -1085,7 +1038,7 @@ async def show_live_chats(callback: CallbackQuery, bot: Bot, dispatcher):
         user2_name = chat["user2_name"] or f"User {chat['user2_id']}"
         created_at = chat["created_at"].strftime("%Y-%m-%d %H:%M")
 
-        text += (
+        parts.append(
             f"💬 Chat #{chat['id']}\n"
             f"👤 {user1_name} ↔️ {user2_name}\n"
             f"🕒 Boshlangan: {created_at}\n\n"
@@ -1103,13 +1056,16 @@ async def show_live_chats(callback: CallbackQuery, bot: Bot, dispatcher):
         [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
     ])
 
-    await safe_edit_text(
-        callback,
-        text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
-        parse_mode=ParseMode.HTML
+    # The edit and the callback ack are independent Bot API calls
+    await asyncio.gather(
+        safe_edit_text(
+            callback,
+            "".join(parts),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            parse_mode=ParseMode.HTML
+        ),
+        callback.answer()
     )
-    await callback.answer()
 
 
 @admin_router.callback_query(F.data.startswith("admin:end_chat:"))
@@ -1127,11 +1083,12 @@ async def end_chat_by_admin(callback: CallbackQuery, bot: Bot, dispatcher):
             f"Ended chat #{chat_id} between {user1_id} and {user2_id}"
         )
 
-        try:
-            await bot.send_message(user1_id, "✅ Chat admin tomonidan tugatildi.")
-            await bot.send_message(user2_id, "✅ Chat admin tomonidan tugatildi.")
-        except:
-            pass
+        # Notify both sides concurrently; either may have blocked the bot
+        await asyncio.gather(
+            bot.send_message(user1_id, "✅ Chat admin tomonidan tugatildi."),
+            bot.send_message(user2_id, "✅ Chat admin tomonidan tugatildi."),
+            return_exceptions=True
+        )
 
         await callback.answer("✅ Chat tugatildi!", show_alert=True)
         # Refresh the live chats list
@@ -1188,37 +1145,40 @@ async def show_chat_details(callback: CallbackQuery, bot: Bot, dispatcher):
 
 # ==================== SETTINGS ====================
 
+SETTINGS_TEMPLATE = (
+    "<b>⚙️ Bot sozlamalari</b>\n\n"
+    "<b>📊 Joriy holat:</b>\n"
+    "👥 Foydalanuvchilar: <b>{total_users}</b>\n"
+    "💬 Faol chatlar: <b>{active_chats}</b>\n"
+    "⛔ Bloklanganlar: <b>{banned}</b>\n"
+    "⏳ Navbatda: <b>{queue}</b>\n\n"
+    "<b>🔧 Sozlamalar:</b>\n"
+    "• Live chat: ✅ Faol\n"
+    "• Anonim xabar: ✅ Faol\n"
+    "• Broadcast: ✅ Faol"
+)
+
+
 @admin_router.callback_query(F.data == "admin:settings")
 async def show_settings(callback: CallbackQuery, bot: Bot, dispatcher):
     """Show bot settings and configuration."""
     pool = dispatcher["db"]
 
-    async with pool.acquire() as conn:
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        active_chats = await conn.fetchval("SELECT COUNT(*) FROM chat_connections")
-        banned_count = await get_banned_users_count(pool)
-        queue_count = await conn.fetchval("SELECT COUNT(*) FROM chat_queue")
+    # Same counts as the statistics panel; share its (cached) query instead of counting again
+    stats = await get_bot_statistics(pool)
 
-    text = (
-        "<b>⚙️ Bot sozlamalari</b>\n\n"
-        "<b>📊 Joriy holat:</b>\n"
-        f"👥 Foydalanuvchilar: <b>{total_users}</b>\n"
-        f"💬 Faol chatlar: <b>{active_chats}</b>\n"
-        f"⛔ Bloklanganlar: <b>{banned_count}</b>\n"
-        f"⏳ Navbatda: <b>{queue_count}</b>\n\n"
-        "<b>🔧 Sozlamalar:</b>\n"
-        "• Live chat: ✅ Faol\n"
-        "• Anonim xabar: ✅ Faol\n"
-        "• Broadcast: ✅ Faol"
-    )
+    text = SETTINGS_TEMPLATE.format_map({
+        "total_users": stats['total_users'],
+        "active_chats": stats['active_chats'],
+        "banned": stats['banned'],
+        "queue": stats['queue'],
+    })
 
-    await safe_edit_text(
+    edited = await safe_edit_text(
         callback,
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Yangilash", callback_data="admin:settings")],
-            [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin:back_to_panel")]
-        ]),
+        reply_markup=SETTINGS_KB,
         parse_mode=ParseMode.HTML
     )
-    await callback.answer()
+    # Refresh with nothing new: say so instead of leaving the click looking ignored
+    await callback.answer(None if edited else "Yangilik yo'q")
@@ -10,10 +10,10 @@ from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 
 from config import LOG_CHANNEL_ID, TIMEZONE
 from db import (
-    is_user_banned, get_user_by_token, log_message, get_or_create_user,
+    get_auth_state, log_message, get_or_create_user,
     get_user_balance_info, get_user_premium_info, VALID_PLANS, PLAN_PRICES,
     get_plan_price, create_payment, update_payment_status, update_user_balance,
-    activate_subscription, check_transaction_id_exists,
+    activate_subscription,
     generate_referral_code, get_user_referral_code,
     notify_admins_new_user, is_user_premium, set_user_hidden
 )
@@ -25,6 +25,27 @@ from aiogram.types import CallbackQuery
 # Create router for user handlers
 user_router = Router()
 
+_TZ = ZoneInfo(TIMEZONE)
+
+# Static keyboards, built once at import instead of on every message
+TOPUP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
+])
+
+PREMIUM_TOPUP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💎 Premium sotib olish", callback_data="premium:purchase")],
+    [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
+])
+
+MAKE_ANONYMOUS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔒 Profilni anonimlashtirish", callback_data="profile:make_anonymous")]
+])
+
+INSUFFICIENT_BALANCE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")],
+    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="premium:purchase")]
+])
+
 
 @user_router.message(Command("start"))
 async def start_handler(message: Message, command: CommandObject, state: FSMContext, bot: Bot, dispatcher):
@@ -77,18 +98,17 @@ async def start_handler(message: Message, command: CommandObject, state: FSMCont
             return
 
         # User clicked on a link with token (for anonymous questions)
-        is_banned, banned_until = await is_user_banned(pool, user_id)
-        if is_banned:
+        auth = await get_auth_state(pool, user_id, command.args)
+        if auth.banned_until is not None:
             await message.answer(
                 "⛔ Siz bloklangan va xabar yubora olmaysiz.\n"
                 "Iltimos, admin bilan bog'laning."
             )
             return
 
-        target = await get_user_by_token(pool, command.args)
-        if target:
+        if auth.target_id is not None:
             await state.set_state(QuestionStates.waiting_for_question)
-            await state.update_data(target_id=target["user_id"])
+            await state.update_data(target_id=auth.target_id)
             await message.answer("<b>Murojaatingizni shu yerga yozing!</b>")
         else:
             await message.answer("<b>⚠️ Noto‘g‘ri havola.</b>")
@@ -316,11 +336,7 @@ async def show_balance(message: Message, bot: Bot, dispatcher):
         f"📊 <b>Jami yuklangan:</b> {total_deposited:,.2f} so'm"
     )
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
-    ])
-
-    await message.answer(balance_text, parse_mode='HTML', reply_markup=keyboard)
+    await message.answer(balance_text, parse_mode='HTML', reply_markup=TOPUP_KB)
 
 
 @user_router.message(Command("premium"))
@@ -354,15 +370,15 @@ async def show_premium_status(message: Message, bot: Bot, dispatcher):
 
         if subscription:
             end_date = subscription['end_date']
-            current_time = datetime.now(ZoneInfo(TIMEZONE))
+            current_time = datetime.now(_TZ)
 
             # Calculate remaining time
             if isinstance(end_date, datetime):
                 # Ensure end_date is timezone-aware
                 if end_date.tzinfo is None:
-                    end_date = end_date.replace(tzinfo=ZoneInfo(TIMEZONE))
-                elif end_date.tzinfo != ZoneInfo(TIMEZONE):
-                    end_date = end_date.astimezone(ZoneInfo(TIMEZONE))
+                    end_date = end_date.replace(tzinfo=_TZ)
+                elif end_date.tzinfo != _TZ:
+                    end_date = end_date.astimezone(_TZ)
 
                 remaining = end_date - current_time
 
@@ -429,18 +445,11 @@ async def show_premium_status(message: Message, bot: Bot, dispatcher):
             f"💡 <b>Premiumga o'tish uchun plan tanlang va to'lov qiling.</b>"
         )
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 Premium sotib olish", callback_data="premium:purchase")],
-            [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
-        ])
-        await message.answer(premium_text, parse_mode='HTML', reply_markup=keyboard)
+        await message.answer(premium_text, parse_mode='HTML', reply_markup=PREMIUM_TOPUP_KB)
         return
 
     # Premium user - add top up button
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
-    ])
-    await message.answer(premium_text, parse_mode='HTML', reply_markup=keyboard)
+    await message.answer(premium_text, parse_mode='HTML', reply_markup=TOPUP_KB)
 
 
 @user_router.message(Command("profile"))
@@ -530,11 +539,7 @@ async def show_profile(message: Message, bot: Bot, dispatcher):
         profile_text += f"🔓 <b>Profil holati:</b> Ochiq\n"
     
     # Add button to make profile anonymous
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔒 Profilni anonimlashtirish", callback_data="profile:make_anonymous")]
-    ])
-    
-    await message.answer(profile_text, parse_mode='HTML', reply_markup=keyboard)
+    await message.answer(profile_text, parse_mode='HTML', reply_markup=MAKE_ANONYMOUS_KB)
 
 
 @user_router.callback_query(F.data == "profile:make_anonymous")
@@ -581,12 +586,7 @@ async def make_profile_anonymous(callback: CallbackQuery, bot: Bot, dispatcher):
             f"💡 <b>Premiumga o'tish uchun plan tanlang va to'lov qiling.</b>"
         )
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 Premium sotib olish", callback_data="premium:purchase")],
-            [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")]
-        ])
-        
-        await callback.message.edit_text(premium_text, parse_mode='HTML', reply_markup=keyboard)
+        await callback.message.edit_text(premium_text, parse_mode='HTML', reply_markup=PREMIUM_TOPUP_KB)
         await callback.answer()
 
 
@@ -608,7 +608,7 @@ async def show_plans(callback: CallbackQuery, dispatcher):
 
     buttons = []
     for plan_key, plan_name in VALID_PLANS.items():
-        price = await get_plan_price(plan_key)
+        price = get_plan_price(plan_key)
         plans_text += f"📅 <b>{plan_name}</b> - <code>{price:,.2f} so'm</code>\n"
         buttons.append([InlineKeyboardButton(
             text=f"📅 {plan_name} - {price:,.2f} so'm",
@@ -657,14 +657,7 @@ async def back_to_premium_status(callback: CallbackQuery, dispatcher):
         f"💡 <b>Premiumga o'tish uchun plan tanlang va to'lov qiling.</b>"
     )
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💎 Premium sotib olish", callback_data="premium:purchase")]
-    ])
-
-    # Add top up button to premium status
-    keyboard.inline_keyboard.append(
-        [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")])
-    await callback.message.edit_text(premium_text, parse_mode='HTML', reply_markup=keyboard)
+    await callback.message.edit_text(premium_text, parse_mode='HTML', reply_markup=PREMIUM_TOPUP_KB)
     await callback.answer()
 
 
@@ -680,7 +673,7 @@ async def select_plan(callback: CallbackQuery, dispatcher):
         return
 
     # Get plan price and user balance
-    price = await get_plan_price(plan)
+    price = get_plan_price(plan)
     balance, _ = await get_user_balance_info(pool, user_id)
     balance = balance or 0.00
 
@@ -722,10 +715,7 @@ async def select_plan(callback: CallbackQuery, dispatcher):
             f"❌ <b>Yetishmaydi:</b> <code>{needed:,.2f} so'm</code>\n\n"
             f"💡 Balansni to'ldirish kerak.",
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💰 Balansni to'ldirish", callback_data="topup:show_referral")],
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="premium:purchase")]
-            ])
+            reply_markup=INSUFFICIENT_BALANCE_KB
         )
         await callback.answer()
 
@@ -4,19 +4,27 @@ Initializes the bot, sets up the dispatcher, and starts polling.
 """
 import asyncio
 import logging
+import logging.handlers
+import queue
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
 from config import BOT_TOKEN
-from db import init_db
+from db import init_db, close_db
 from handlers.user_handlers import user_router
 from handlers.admin_handlers import admin_router
 from handlers.chat_handlers import chat_router
 from middleware import UserUpdateMiddleware
 
-# Configure logging
+# Configure logging: handlers only enqueue records, a listener thread does the I/O
 logging.basicConfig(level=logging.INFO)
+_log_queue = queue.SimpleQueue()
+_root_logger = logging.getLogger()
+log_listener = logging.handlers.QueueListener(
+    _log_queue, *_root_logger.handlers, respect_handler_level=True
+)
+_root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
 
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -25,6 +33,8 @@ dp = Dispatcher()
 
 async def main():
     """Main function to initialize database and start the bot."""
+    log_listener.start()
+
     # Initialize database connection pool
     pool = await init_db()
     dp["db"] = pool
@@ -42,8 +52,9 @@ async def main():
         # Start polling
         await dp.start_polling(bot)
     finally:
-        # Close database pool on shutdown
-        await pool.close()
+        # Flush queued writes and close database pool on shutdown
+        await close_db(pool)
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -2,8 +2,11 @@
 Utility functions module.
 Contains helper functions for token generation, datetime formatting, and other utilities.
 """
+import asyncio
 import string
 import random
+import time
+from collections import OrderedDict
 
 
 def generate_token(length=8):
@@ -13,3 +16,118 @@ def generate_token(length=8):
 
 
 
+class TTLCache:
+    """
+    Small in-process cache whose entries expire `ttl` seconds after being set.
+    Oldest entries are evicted once more than `maxsize` keys are stored.
+
+    Every set/pop bumps the key's generation. A read-through fill takes
+    generation(key) before its query and writes with set_if_unchanged, so a result
+    read before a concurrent invalidation can't be cached over it.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # key -> counter value at its last set/pop, bounded like _data. Keys that fell
+        # out report _floor (>= anything they last had), so a fill for them is skipped.
+        self._counter = 0
+        self._changed = OrderedDict()
+        self._floor = 0
+
+    def _bump(self, key):
+        self._counter += 1
+        self._changed[key] = self._counter
+        self._changed.move_to_end(key)
+        while len(self._changed) > self.maxsize:
+            self._changed.popitem(last=False)
+            self._floor = self._counter
+
+    def generation(self, key) -> int:
+        """Return a token that changes whenever key is set or popped."""
+        return self._changed.get(key, self._floor)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired."""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        """Cache value under key for `ttl` seconds."""
+        self._bump(key)
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Drop key from the cache, returning its value if it was cached."""
+        self._bump(key)
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def set_if_unchanged(self, key, value, generation: int) -> bool:
+        """
+        Cache value only if key hasn't been set or popped since generation(key) returned
+        `generation`. Returns True if the value was stored.
+        """
+        if self.generation(key) != generation:
+            return False
+        self.set(key, value)
+        return True
+
+    def clear(self):
+        """Drop every cached entry."""
+        self._counter += 1
+        self._floor = self._counter
+        self._changed.clear()
+        self._data.clear()
+
+
+class RateLimiter:
+    """
+    Async token bucket allowing at most `rate` acquisitions per `period` seconds.
+    pause() blocks every caller for a while, e.g. when the API asks us to back off.
+    """
+
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                elapsed = now - self._updated
+                self._tokens = min(self.rate, self._tokens + elapsed * self.rate / self.period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    def pause(self, seconds: float):
+        """Hold back all acquisitions for `seconds` from now."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False